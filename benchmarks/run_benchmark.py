@@ -0,0 +1,224 @@
+"""
+End to end benchmark of the search pipeline: clean_query -> get_results -> get_relevant_results, against
+the local stand-in server (standin_server.py), so no Google quota is used. Runs the searches at every
+concurrency level given and reports the p50/p95/p99 latency, the throughput and the peak RSS. The report
+is compared with a stored baseline to catch regressions.
+
+Run from the root of the repository:
+    py -3 benchmarks/run_benchmark.py                      (compares with benchmarks/baseline.json)
+    py -3 benchmarks/run_benchmark.py --save-baseline      (saves the report as the new baseline)
+    py -3 benchmarks/run_benchmark.py --concurrency 1,8,32 --searches 64 --page-kb 500 --error-rate 0.05
+    py -3 benchmarks/run_benchmark.py --pages 1                (a single Place API page per search)
+Exits with status 1 if a regression was found.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPOSITORY_DIR, "benchmarks", "baseline.json")
+
+# (food, extras) and places of the searches, combined in turns so the searches of a level are different
+SEARCHES = [
+    ("pizza", "terraza"),
+    ("sushi", ""),
+    ("ceviche", "parqueo"),
+    ("hamburguesa", "familiar"),
+    ("comida vegana", "wifi"),
+    ("tacos", "musica"),
+]
+PLACES = ["escazu", "sabana", "heredia", "cartago", "san pedro", "santa ana", "curridabat"]
+
+"""
+Returns the search (food, place, extras) of the number given. The first len(SEARCHES) * len(PLACES)
+searches are all different.
+"""
+def get_search(number):
+    food, extras = SEARCHES[number % len(SEARCHES)]
+    return food, PLACES[number % len(PLACES)], extras
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="End to end benchmark of the search pipeline")
+    parser.add_argument("--concurrency", default="1,4,16", help="concurrent searches of every level, separated by commas")
+    parser.add_argument("--searches", type=int, default=32, help="searches of every concurrency level")
+    parser.add_argument("--api-latency", type=float, default=0.2, help="median latency of the APIs, in seconds")
+    parser.add_argument("--page-latency", type=float, default=0.3, help="median latency of the pages, in seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="sigma of the log-normal latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="rate of failed requests of every endpoint")
+    parser.add_argument("--pages", type=int, default=3, help="maximum Place API pages per search (API_CALLS_AMOUNT)")
+    parser.add_argument("--page-kb", type=int, default=200, help="size of the restaurant pages, in KB")
+    parser.add_argument("--warm", action="store_true", help="keeps the caches between levels (by default every level starts cold)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="saves the report as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    return parser.parse_args()
+
+"""
+Configures the pipeline through the environment before importing it: the stand-in endpoints, caches in
+a temporary directory and at most the Place API pages given per search.
+"""
+def configure_environment(base_url, cache_dir, pages):
+    os.environ["PLACE_API_URL"] = base_url + "/place/textsearch/json"
+    os.environ["SEARCH_API_URL"] = base_url + "/customsearch/v1"
+    os.environ["CACHE_DB_PATH"] = os.path.join(cache_dir, "benchmark.sqlite3")
+    os.environ["INDEX_DIR"] = os.path.join(cache_dir, "index")
+    os.environ["API_CALLS_AMOUNT"] = str(pages)
+    os.environ.setdefault("PROGRESSIVE_RESULTS", "0")
+    os.environ.setdefault("BOT_TOKEN", "benchmark")
+    # The stand-in has no quota, the scheduler must not throttle or degrade the pipeline measured
+    os.environ.setdefault("PLACES_RATE", "100000")
+    os.environ.setdefault("SEARCH_RATE", "100000")
+    os.environ.setdefault("SEARCH_DAILY_QUOTA", "0")
+
+"""
+Returns the percentile given (0 to 100) of the values.
+"""
+def percentile(values, percent):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return None
+    position = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[position]
+
+"""
+Returns the peak resident memory of the process, in MB.
+"""
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024 # bytes in macOS, KB in Linux
+
+"""
+Empties the in-memory caches and the tables of the persistent ones, so the level starts cold.
+"""
+def reset_caches():
+    from cache import get_connection, places_cache
+    from page_store import PAGES_TABLE, page_store
+    from site_index import site_index
+    places_cache.memory.clear()
+    page_store.memory.clear()
+    site_index.entries.clear()
+    connection = get_connection(os.environ["CACHE_DB_PATH"])
+    for table in ("places_text_search", PAGES_TABLE, "sites"):
+        connection.execute("DELETE FROM " + table)
+
+"""
+Runs a single search through the pipeline. Returns its latency in seconds and if it found results.
+"""
+async def run_search(search, logger):
+    from retrieval_algorithms import clean_query, get_relevant_results, get_results
+    user = SimpleNamespace(first_name="benchmark", id=0)
+    start = time.perf_counter()
+    status, query = clean_query(*[text.lower() for text in search])
+    found = False
+    if status:
+        page = await get_results(query, logger, user)
+        if page is not None:
+            ranking = await get_relevant_results(page, query, logger, user)
+            found = ranking is not None and len(ranking) > 0
+    return time.perf_counter() - start, found
+
+"""
+Runs the searches with the concurrency given. Returns the report of the level.
+"""
+async def run_level(concurrency, searches, logger):
+    semaphore = asyncio.Semaphore(concurrency)
+    async def limited(number):
+        async with semaphore:
+            return await run_search(get_search(number), logger)
+    start = time.perf_counter()
+    results = await asyncio.gather(*[limited(number) for number in range(searches)])
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    return {
+        "concurrency": concurrency,
+        "searches": searches,
+        "with_results": sum(1 for _, found in results if found),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": searches / elapsed, # searches per second
+        "peak_rss_mb": get_peak_rss(),
+    }
+
+"""
+Compares the report with the baseline. Returns the list of regressions found, as messages.
+"""
+def compare(report, baseline, tolerance):
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        expected = baseline_levels.get(level["concurrency"])
+        if expected is None:
+            continue
+        for metric in ("p50", "p95", "p99", "peak_rss_mb"):
+            if level[metric] > expected[metric] * (1 + tolerance):
+                regressions.append(f"concurrency {level['concurrency']}: {metric} {level[metric]:.3f} > baseline {expected[metric]:.3f}")
+        if level["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"concurrency {level['concurrency']}: throughput {level['throughput']:.3f} < baseline {expected['throughput']:.3f}")
+    return regressions
+
+async def run(arguments, levels):
+    from retrieval_algorithms import close_client
+    logger = logging.getLogger("benchmark")
+    report = []
+    try:
+        for concurrency in levels:
+            if not arguments.warm:
+                reset_caches()
+            report.append(await run_level(concurrency, arguments.searches, logger))
+            print(json.dumps(report[-1]))
+    finally:
+        await close_client()
+    return report
+
+def main():
+    arguments = get_arguments()
+    sys.path.insert(0, REPOSITORY_DIR)
+    from standin_server import Profile, StandInConfig, start_server_process
+
+    config = StandInConfig(
+        places=Profile(arguments.api_latency, arguments.sigma, arguments.error_rate),
+        search=Profile(arguments.api_latency, arguments.sigma, arguments.error_rate),
+        pages=Profile(arguments.page_latency, arguments.sigma, arguments.error_rate),
+        page_kb=arguments.page_kb,
+    )
+    server, port = start_server_process(config)
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        configure_environment("http://127.0.0.1:" + str(port), cache_dir, arguments.pages)
+        levels = [int(level) for level in arguments.concurrency.split(",")]
+        report = {
+            "settings": {key: value for key, value in vars(arguments).items()
+                         if key not in ("baseline", "save_baseline", "tolerance")},
+            "levels": asyncio.run(run(arguments, levels)),
+        }
+    server.terminate()
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print("Baseline saved in " + arguments.baseline)
+        return 0
+    if not os.path.exists(arguments.baseline):
+        print("There is no baseline to compare with. Run with --save-baseline to create it")
+        return 0
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["settings"] != report["settings"]:
+        print("Warning: the settings are different from the ones of the baseline")
+    regressions = compare(report, baseline, arguments.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+    if len(regressions) == 0:
+        print("No regressions against the baseline")
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Local stand-in of the services used by the bot, so the pipeline can be measured without using the
+Google quota. Emulates:
+    /place/textsearch/json   Place API text search, 20 restaurants per page and PLACE_PAGES pages per query
+    /customsearch/v1         Custom Search API, the first link is the page of the restaurant
+    /site/<id>               the page of a restaurant, HTML of the configured size
+Every endpoint waits a log-normal latency and fails with the configured error rate.
+
+Can be used alone:
+    py -3 benchmarks/standin_server.py 8765
+and then start the bot with PLACE_API_URL=http://127.0.0.1:8765/place/textsearch/json and
+SEARCH_API_URL=http://127.0.0.1:8765/customsearch/v1
+"""
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+PLACES_PER_QUERY = 20 # per page
+PLACE_PAGES = 3
+
+# Words of the restaurant pages. The ones of the benchmark queries appear with more frequency
+VOCABULARY = ["pizza", "sushi", "hamburguesa", "vegano", "casado", "ceviche", "cafe", "postres", "tacos",
+              "parqueo", "terraza", "familiar", "wifi", "escazu", "heredia", "sabana", "cartago", "menu",
+              "reservas", "horario", "precio", "bebidas", "almuerzo", "cena", "desayuno", "musica"]
+FILLER = ["restaurante", "costa", "rica", "comida", "servicio", "calidad", "ambiente", "contacto",
+          "ubicacion", "nosotros", "galeria", "promociones", "telefono", "correo", "inicio"]
+
+"""
+Latency and error profile of an endpoint. The latency is log-normal with the median and sigma given.
+"""
+class Profile:
+    def __init__(self, median, sigma=0.5, error_rate=0.0):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    """
+    Returns the seconds to wait for a request.
+    """
+    def latency(self):
+        if self.median <= 0:
+            return 0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    """
+    Returns if the request must fail.
+    """
+    def fails(self):
+        return random.random() < self.error_rate
+
+"""
+Configuration of the stand-in server.
+"""
+class StandInConfig:
+    def __init__(self, places=None, search=None, pages=None, page_kb=200, website_ratio=0.3):
+        self.places = places or Profile(0.3)
+        self.search = search or Profile(0.3)
+        self.pages = pages or Profile(0.5, sigma=0.8)
+        self.page_kb = page_kb # size of the restaurant pages
+        self.website_ratio = website_ratio # places that include their website in the Place API result
+
+"""
+Returns a random generator that always gives the same values for the same text.
+"""
+def seeded_random(text):
+    return random.Random(zlib.crc32(text.encode("utf-8")))
+
+"""
+Returns the HTML of the page of the restaurant, of size_kb kilobytes approximately.
+"""
+def make_page(site_id, size_kb):
+    generator = seeded_random(site_id)
+    topics = generator.sample(VOCABULARY, 6)
+    paragraphs = []
+    size = 0
+    while size < size_kb * 1024:
+        words = [generator.choice(topics) if generator.random() < 0.15 else generator.choice(FILLER)
+                 for _ in range(60)]
+        paragraph = "<p class=\"texto\">" + " ".join(words) + "</p>\n"
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    return ("<html><head><title>Restaurante " + site_id + "</title><script>var menu = {pizza: 1};</script>"
+            "</head><body>" + "".join(paragraphs) + "</body></html>").encode("utf-8")
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pages = {} # { site id : HTML bytes }, generated once
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path.endswith("/textsearch/json"):
+            self.respond(config.places, "application/json", lambda: self.places(params, config))
+        elif url.path.endswith("/customsearch/v1"):
+            self.respond(config.search, "application/json", lambda: self.search(params))
+        elif url.path.startswith("/site/"):
+            site_id = url.path[len("/site/"):]
+            self.respond(config.pages, "text/html; charset=utf-8", lambda: self.page(site_id, config))
+        else:
+            self.send_error(404)
+
+    """
+    Waits the latency of the profile and sends the body created by make_body, or an error.
+    """
+    def respond(self, profile, content_type, make_body):
+        time.sleep(profile.latency())
+        if profile.fails():
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = make_body()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def places(self, params, config):
+        page = 1
+        query = params.get("query", [""])[0]
+        if "pagetoken" in params: # "<page>-<query in hexadecimal>"
+            page, hex_query = params["pagetoken"][0].split("-", 1)
+            page, query = int(page), bytes.fromhex(hex_query).decode("utf-8")
+        generator = seeded_random(query + " " + str(page))
+        results = []
+        for _ in range(PLACES_PER_QUERY):
+            number = generator.randint(0, 999)
+            result = {
+                "place_id": "standin-" + str(number),
+                "name": "Restaurante " + str(number),
+                "rating": round(generator.uniform(3, 5), 1),
+                "price_level": generator.randint(1, 4),
+                "geometry": {"location": {"lat": 9.9 + generator.random() / 10, "lng": -84.1 + generator.random() / 10}},
+                "opening_hours": {"open_now": generator.random() < 0.7},
+            }
+            if generator.random() < config.website_ratio:
+                result["website"] = self.site_url(str(number))
+            results.append(result)
+        response = {"results": results, "status": "OK"}
+        if page < PLACE_PAGES:
+            response["next_page_token"] = str(page + 1) + "-" + query.encode("utf-8").hex()
+        return json.dumps(response).encode("utf-8")
+
+    def search(self, params):
+        query = params.get("q", [""])[0]
+        number = "".join(char for char in query if char.isdigit()) or str(zlib.crc32(query.encode("utf-8")) % 1000)
+        return json.dumps({"items": [{"link": self.site_url(number)}]}).encode("utf-8")
+
+    def page(self, site_id, config):
+        if site_id not in StandInHandler.pages:
+            StandInHandler.pages[site_id] = make_page(site_id, config.page_kb)
+        return StandInHandler.pages[site_id]
+
+    def site_url(self, site_id):
+        return "http://" + self.server.server_address[0] + ":" + str(self.server.server_address[1]) + "/site/" + site_id
+
+    def log_message(self, format, *args):
+        pass # quiet
+
+"""
+Server of the stand-in. Requests cancelled by the client (for example, hedged ones) are not errors.
+"""
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+"""
+Starts the stand-in server in a background thread. Returns the server, whose base URL is
+http://127.0.0.1:<server.server_address[1]>. port 0 chooses a free port.
+"""
+def start_server(config=None, port=0):
+    server = StandInServer(("127.0.0.1", port), StandInHandler)
+    server.config = config or StandInConfig()
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+"""
+Runs the server until the process is terminated. Sends its port through the queue given.
+"""
+def serve(config, port, port_queue):
+    server = start_server(config, port)
+    port_queue.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+"""
+Starts the stand-in server in another process, so it doesn't compete for the interpreter with the code
+being measured. Returns the process (to terminate it) and the port of the server.
+"""
+def start_server_process(config=None, port=0):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(config or StandInConfig(), port, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+if __name__ == "__main__":
+    server = start_server(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print("Stand-in server listening on http://127.0.0.1:" + str(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,149 @@
+"""
+Two tier cache used to avoid repeating requests to the Google APIs. The first tier is an in-memory
+LRU dictionary and the second one is a SQLite database that survives restarts of the bot. Every tier
+has its own time to live (TTL) in seconds.
+"""
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'coco_cache.sqlite3') # empty disables the disk tier
+
+# Place API cache constants
+PLACES_CACHE_SIZE = int(os.getenv('PLACES_CACHE_SIZE', 256)) # entries in memory
+PLACES_CACHE_MEMORY_TTL = int(os.getenv('PLACES_CACHE_MEMORY_TTL', 60 * 30))
+PLACES_CACHE_DISK_TTL = int(os.getenv('PLACES_CACHE_DISK_TTL', 60 * 60 * 24))
+
+_connections = {} # { database path : sqlite connection }
+
+"""
+Returns the SQLite connection for the path given. Connections are shared by every cache or store
+using the same file. Returns None if the path is empty, as the disk tier is disabled.
+"""
+def get_connection(path):
+    if not path:
+        return None
+    if path not in _connections:
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _connections[path] = connection
+    return _connections[path]
+
+"""
+Normalizes the query so equivalent queries share the same key: lower case and single spaces.
+"""
+def normalize_key(query):
+    return " ".join(str(query).lower().split())
+
+"""
+Cache with an LRU memory tier and a SQLite disk tier. Values must be serializable as JSON.
+Counts the hits of every tier and the misses so the sizes and TTLs can be adjusted.
+"""
+class ResultCache:
+    def __init__(self, name, max_entries, memory_ttl, disk_ttl, path=CACHE_DB_PATH):
+        self.name = name
+        self.max_entries = max_entries
+        self.memory_ttl = memory_ttl
+        self.disk_ttl = disk_ttl
+        self.memory = OrderedDict() # { key : (stored_at, value) }
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} (key TEXT PRIMARY KEY, value TEXT, stored_at REAL)"
+            )
+
+    """
+    Returns the value saved for the key or None if it is not cached or it already expired.
+    """
+    def get(self, key):
+        key = normalize_key(key)
+        now = time.time()
+        if key in self.memory:
+            stored_at, value = self.memory[key]
+            if now - stored_at < self.memory_ttl:
+                self.memory.move_to_end(key) # most recently used
+                self.memory_hits += 1
+                return value
+            del self.memory[key] # expired
+
+        if self.connection is not None:
+            row = self.connection.execute(
+                f"SELECT value, stored_at FROM {self.name} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] < self.disk_ttl:
+                value = json.loads(row[0])
+                self._remember(key, value, now)
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    """
+    Returns the value saved for the key even if it expired, or None if it was never saved (or purged).
+    Used when the API can't be called, as an old answer is better than none.
+    """
+    def get_stale(self, key):
+        key = normalize_key(key)
+        if key in self.memory:
+            return self.memory[key][1]
+        if self.connection is not None:
+            row = self.connection.execute(f"SELECT value FROM {self.name} WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+        return None
+
+    """
+    Saves the value in both tiers.
+    """
+    def set(self, key, value):
+        key = normalize_key(key)
+        now = time.time()
+        self._remember(key, value, now)
+        if self.connection is not None:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now)
+            )
+
+    """
+    Removes the expired values from the disk tier.
+    """
+    def purge(self):
+        if self.connection is not None:
+            self.connection.execute(
+                f"DELETE FROM {self.name} WHERE stored_at < ?", (time.time() - self.disk_ttl,)
+            )
+
+    """
+    Returns the counters of the cache as a dictionary.
+    """
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self.memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+        }
+
+    """
+    Saves the value in the memory tier and evicts the least recently used value if it is full.
+    """
+    def _remember(self, key, value, stored_at):
+        self.memory[key] = (stored_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+# Cache of the Place API text search responses, keyed by the cleaned query
+places_cache = ResultCache("places_text_search", PLACES_CACHE_SIZE,
+                            PLACES_CACHE_MEMORY_TTL, PLACES_CACHE_DISK_TTL)
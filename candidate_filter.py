@@ -0,0 +1,166 @@
+"""
+Filter of the candidates of a ranking, run before any request is made for them. Skips the results that
+were already seen (same place_id or same page, even if two restaurants share it) and the pages of sites
+that aren't restaurants (social networks, travel guides, directories...), so no time or quota is spent
+on them.
+
+The sites are matched by domain with a suffix trie of the hostnames: "facebook.com" denies
+"www.facebook.com" and "m.facebook.com" but not "newfacebookrestaurant.com". A domain "name.*" matches
+the name under any top level domain or country second level domain, as "tripadvisor.*" denies
+"tripadvisor.com", "tripadvisor.es" and "tripadvisor.com.mx". The denied and allowed
+domains can be configured with DENIED_DOMAINS and ALLOWED_DOMAINS (comma separated). Allowed domains
+win over denied ones.
+"""
+import os
+from urllib.parse import parse_qsl, urlencode, urlparse
+from telemetry import increment
+from top_k import get_result_key
+
+DEFAULT_DENIED_DOMAINS = ("facebook.com,instagram.com,twitter.com,x.com,tiktok.com,youtube.com,pinterest.com,"
+                          "linkedin.com,whatsapp.com,wa.me,linktr.ee,tripadvisor.*,yelp.*,foursquare.com,"
+                          "expedia.*,booking.com,wikipedia.org,wikiloc.com,moovitapp.com,ubereats.com,rappi.*,"
+                          "google.com,goo.gl,maps.app.goo.gl,ucr.ac.cr,mochileros.org,viajeros.com")
+DENIED_DOMAINS = os.getenv('DENIED_DOMAINS', DEFAULT_DENIED_DOMAINS)
+ALLOWED_DOMAINS = os.getenv('ALLOWED_DOMAINS', "")
+DENIED_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".zip", ".doc", ".docx") # not web pages
+
+# Second level domains under a country code, as "com" in "com.mx", matched by the "name.*" domains
+COUNTRY_SECOND_LEVELS = {"com", "co", "net", "org", "gob", "gov", "ac", "or", "ne"}
+
+# Query parameters that don't change the page
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "source"}
+
+"""
+Returns the labels of the hostname from the top level domain, without the trailing dot.
+"""
+def get_labels(hostname):
+    return hostname.lower().strip(".").split(".")[::-1]
+
+"""
+Set of domains compiled as a suffix trie of their labels ("com" -> "facebook"). A hostname matches if
+it is one of the domains or a subdomain of one of them, checking each of its labels once. The names of
+the "name.*" domains are kept apart and checked below the public suffix of the hostname.
+"""
+class DomainMatcher:
+    def __init__(self, domains):
+        self.trie = {}
+        self.names = set() # of the "name.*" domains
+        self.size = 0
+        for domain in domains:
+            domain = domain.strip().lower()
+            if domain == "":
+                continue
+            self.size += 1
+            if domain.endswith(".*"):
+                self.names.add(domain[:-len(".*")])
+                continue
+            node = self.trie
+            for label in get_labels(domain):
+                node = node.setdefault(label, {})
+            node[None] = True # end of a domain
+
+    """
+    Returns the matcher of the domains in the text given, separated by commas.
+    """
+    @staticmethod
+    def from_text(text):
+        return DomainMatcher(text.split(","))
+
+    def __len__(self):
+        return self.size
+
+    """
+    Returns if the hostname is one of the domains or a subdomain of one of them.
+    """
+    def matches(self, hostname):
+        labels = get_labels(hostname)
+        if len(self.names) > 0 and self.matches_name(labels):
+            return True
+        node = self.trie
+        for label in labels:
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    """
+    Returns if the labels (from the top level domain) are of one of the "name.*" domains: the name is
+    right below the top level domain ("yelp.es") or below a country second level domain ("yelp.com.mx").
+    """
+    def matches_name(self, labels):
+        if len(labels) >= 2 and labels[1] in self.names:
+            return True
+        return (len(labels) >= 3 and len(labels[0]) == 2 and labels[1] in COUNTRY_SECOND_LEVELS
+                and labels[2] in self.names)
+
+denied_domains = DomainMatcher.from_text(DENIED_DOMAINS)
+allowed_domains = DomainMatcher.from_text(ALLOWED_DOMAINS)
+
+"""
+Returns if the page of the url can be a restaurant website: its domain isn't denied (or it is allowed)
+and it isn't a file.
+"""
+def url_allowed(url):
+    parsed = urlparse(url)
+    hostname = parsed.hostname
+    if hostname is None or parsed.scheme not in ("http", "https"):
+        return False
+    if allowed_domains.matches(hostname):
+        return True
+    return not denied_domains.matches(hostname) and not parsed.path.lower().endswith(DENIED_EXTENSIONS)
+
+"""
+Returns the canonical form of the url, so the same page is recognized behind different urls: without
+the scheme, "www.", the default port, the fragment, the trailing slash and the tracking parameters.
+"""
+def canonical_url(url):
+    parsed = urlparse(url.strip())
+    hostname = (parsed.hostname or "").lower()
+    if hostname.startswith("www."):
+        hostname = hostname[len("www."):]
+    port = parsed.port if parsed.port not in (None, 80, 443) else None
+    params = sorted((key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                    if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_"))
+    canonical = hostname + (":" + str(port) if port else "") + (parsed.path.rstrip("/") or "")
+    return canonical + ("?" + urlencode(params) if params else "")
+
+"""
+Candidate filter of a single ranking, shared by every worker that fetches its results.
+"""
+class CandidateFilter:
+    def __init__(self):
+        self.keys = set() # place_id (or name) of the results admitted
+        self.pages = {} # { canonical url : key of the result that claimed it }
+
+    """
+    Returns if the result must be ranked. Skips repeated results and, if its website is already known
+    (website, the one saved in the site index or the one of the result), the websites denied or
+    claimed by another result.
+    """
+    def admit(self, result, website=None):
+        key = get_result_key(result)
+        if key is None or key in self.keys:
+            increment("coco_candidates_skipped_total", reason="repeated")
+            return False
+        website = website or result.get("website")
+        if website and not self.admit_url(website, key):
+            return False
+        self.keys.add(key)
+        return True
+
+    """
+    Returns if the page of the url must be fetched for the result of the key given. Skips the websites
+    denied and the ones already claimed by another result.
+    """
+    def admit_url(self, url, key):
+        if not url_allowed(url):
+            increment("coco_candidates_skipped_total", reason="denied")
+            return False
+        canonical = canonical_url(url)
+        owner = self.pages.setdefault(canonical, key)
+        if owner != key:
+            increment("coco_candidates_skipped_total", reason="same_page")
+            return False
+        return True
@@ -0,0 +1,64 @@
+"""
+Offline crawler of the restaurant websites. Walks every website known by the site index, saves the
+term frequency of its page in the page store and then builds the inverted index used when INDEX_MODE=1.
+Meant to run as a background job, for example:
+
+    py -3 crawler.py            (a single crawl)
+    py -3 crawler.py 21600      (crawls every 6 hours)
+"""
+import asyncio
+import logging
+import sys
+from inverted_index import INDEX_DIR, build_index
+from candidate_filter import url_allowed
+from page_store import page_store
+from retrieval_algorithms import MAX_CONCURRENT_REQUESTS, close_client, get_client, get_page_terms
+from site_index import site_index
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+"""
+Fetches every website of the site index that is not fresh in the page store, except the ones that can't be
+a restaurant website (social networks, travel guides, files...). Returns the amount of websites that failed.
+"""
+async def crawl():
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async def crawl_website(url):
+        async with semaphore:
+            try:
+                await get_page_terms(get_client(), url)
+                return True
+            except Exception as e:
+                logger.warning("Error %s crawling %s", str(e), url)
+                return False
+    site_index.reload() # the bot saved new websites since the last crawl
+    websites = [url for url in site_index.websites() if url_allowed(url)]
+    logger.info("Crawling %d websites", len(websites))
+    crawled = await asyncio.gather(*[crawl_website(url) for url in websites])
+    logger.info("Page store stats: %s", page_store.stats())
+    return crawled.count(False)
+
+"""
+Crawls the websites and rebuilds the index with every page of the page store.
+"""
+async def crawl_and_index():
+    try:
+        failed = await crawl()
+    finally:
+        await close_client()
+    documents = build_index(page_store.pages(), INDEX_DIR)
+    logger.info("Index built in %s with %d documents (%d websites failed)", INDEX_DIR, documents, failed)
+
+def main():
+    interval = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    while True:
+        asyncio.run(crawl_and_index())
+        if interval <= 0:
+            break
+        asyncio.run(asyncio.sleep(interval))
+
+if __name__ == "__main__":
+    main()
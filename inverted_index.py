@@ -0,0 +1,172 @@
+"""
+On-disk inverted index of the restaurant pages, built offline by crawler.py. When the index mode is
+enabled, the ranking reads the term frequencies of a page from the index instead of fetching it.
+
+The index is a directory with four files:
+    meta.json      { "analyzer" : version of the text analysis that produced the terms }
+    docs.json      list of [url, length] where the position is the document id
+    lexicon.json   { term : [offset, count] } position of the postings of the term
+    postings.bin   for every term, count document ids followed by count term frequencies (uint32)
+postings.bin is memory mapped, so loading the index doesn't read the postings.
+"""
+import json
+import mmap
+import os
+import shutil
+from array import array
+from bisect import bisect_left
+from text_analysis import ANALYZER_VERSION
+
+INDEX_MODE = os.getenv('INDEX_MODE', '0') == '1'
+INDEX_DIR = os.getenv('INDEX_DIR', 'index')
+
+META_FILE = "meta.json"
+DOCS_FILE = "docs.json"
+LEXICON_FILE = "lexicon.json"
+POSTINGS_FILE = "postings.bin"
+
+"""
+Builds the index in the directory given from documents, an iterable of tuples (url, {term: count}).
+The new index is written next to the old one and then swapped, so readers never see a partial index.
+Returns the amount of documents indexed.
+"""
+def build_index(documents, directory=INDEX_DIR):
+    docs = []
+    postings = {} # { term : ([doc ids], [term frequencies]) }
+    for url, terms in documents:
+        doc_id = len(docs)
+        docs.append([url, sum(terms.values())])
+        for term, count in terms.items():
+            doc_ids, frequencies = postings.setdefault(term, ([], []))
+            doc_ids.append(doc_id) # ascending as documents are added in order
+            frequencies.append(count)
+
+    new_directory = directory + ".new"
+    shutil.rmtree(new_directory, ignore_errors=True)
+    os.makedirs(new_directory)
+    lexicon = {}
+    offset = 0
+    with open(os.path.join(new_directory, POSTINGS_FILE), "wb") as postings_file:
+        for term in sorted(postings):
+            doc_ids, frequencies = postings[term]
+            array("I", doc_ids).tofile(postings_file)
+            array("I", frequencies).tofile(postings_file)
+            lexicon[term] = [offset, len(doc_ids)]
+            offset += 2 * len(doc_ids)
+    with open(os.path.join(new_directory, LEXICON_FILE), "w", encoding="utf-8") as lexicon_file:
+        json.dump(lexicon, lexicon_file, ensure_ascii=False)
+    with open(os.path.join(new_directory, DOCS_FILE), "w", encoding="utf-8") as docs_file:
+        json.dump(docs, docs_file, ensure_ascii=False)
+    with open(os.path.join(new_directory, META_FILE), "w", encoding="utf-8") as meta_file:
+        json.dump({"analyzer": ANALYZER_VERSION}, meta_file)
+
+    old_directory = directory + ".old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old_directory)
+    os.rename(new_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+    return len(docs)
+
+"""
+Read only view of an index directory.
+"""
+class InvertedIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = os.path.getmtime(os.path.join(directory, DOCS_FILE))
+        with open(os.path.join(directory, DOCS_FILE), encoding="utf-8") as docs_file:
+            docs = json.load(docs_file)
+        with open(os.path.join(directory, LEXICON_FILE), encoding="utf-8") as lexicon_file:
+            self.lexicon = json.load(lexicon_file)
+        meta_path = os.path.join(directory, META_FILE)
+        self.analyzer = None # indexes built before the meta file have an older analysis
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as meta_file:
+                self.analyzer = json.load(meta_file).get("analyzer")
+        self.urls = {url: doc_id for doc_id, (url, _) in enumerate(docs)} # { url : doc id }
+        self.lengths = [length for _, length in docs]
+        with open(os.path.join(directory, POSTINGS_FILE), "rb") as postings_file:
+            if os.fstat(postings_file.fileno()).st_size > 0:
+                self.mapped = mmap.mmap(postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.postings = memoryview(self.mapped).cast("I")
+            else:
+                self.mapped = None
+                self.postings = memoryview(array("I"))
+
+    """
+    Returns the amount of documents in the index.
+    """
+    def __len__(self):
+        return len(self.lengths)
+
+    """
+    Returns if the page of the url is in the index.
+    """
+    def __contains__(self, url):
+        return url in self.urls
+
+    """
+    Returns the amount of documents that contain the term.
+    """
+    def document_frequency(self, term):
+        posting = self.lexicon.get(term)
+        return posting[1] if posting is not None else 0
+
+    """
+    Returns the length of the document of the url, in terms.
+    """
+    def document_length(self, url):
+        return self.lengths[self.urls[url]]
+
+    """
+    Returns the term frequency {term: count} of the terms given in the page of the url, or None if the
+    page is not indexed. Terms that are not in the page are not included.
+    """
+    def term_frequencies(self, url, terms):
+        doc_id = self.urls.get(url)
+        if doc_id is None:
+            return None
+        frequencies = {}
+        for term in terms:
+            posting = self.lexicon.get(term)
+            if posting is None:
+                continue
+            offset, count = posting
+            doc_ids = self.postings[offset:offset + count]
+            position = bisect_left(doc_ids, doc_id)
+            if position < count and doc_ids[position] == doc_id:
+                frequencies[term] = self.postings[offset + count + position]
+        return frequencies
+
+    """
+    Releases the memory map.
+    """
+    def close(self):
+        self.postings.release()
+        if self.mapped is not None:
+            self.mapped.close()
+
+_index = None
+
+"""
+Returns the index loaded from INDEX_DIR or None if the index mode is disabled, the index wasn't built
+yet or it was built with another version of the text analysis. Loads the index again if the crawler
+rebuilt it.
+"""
+def get_index():
+    global _index
+    if not INDEX_MODE:
+        return None
+    docs_path = os.path.join(INDEX_DIR, DOCS_FILE)
+    if not os.path.exists(docs_path):
+        return _index # not built yet
+    try:
+        version = os.path.getmtime(docs_path)
+        if _index is None or _index.version != version:
+            _index = InvertedIndex(INDEX_DIR)
+    except Exception as e:
+        print(e)
+    if _index is not None and _index.analyzer != ANALYZER_VERSION:
+        return None # its terms can't be compared with the query until the crawler rebuilds it
+    return _index
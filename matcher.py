@@ -0,0 +1,213 @@
+"""
+Single pass counting of terms in a text that may arrive in chunks, for example while a page downloads.
+
+TermMatcher is compiled once per query with all of its terms and counts them with a single scan of the
+text, instead of one scan per term. The terms are compiled as one alternation ordered as a trie (longest
+term first), so the scan runs inside the regular expression engine. Matching may be limited to whole
+words and made insensitive to accents. With stemmed terms (text_analysis.normalize_term), every word
+that starts like a term is matched and counted only if its term is the same, so "tacos" counts as "tac".
+
+TokenCounter counts every term of the text, with the same analysis of text_analysis.count_terms.
+
+Both keep the end of the last chunk until the next one arrives, so a term split between two chunks is
+still counted once.
+"""
+import re
+from collections import Counter
+from text_analysis import TOKEN_PATTERN, fold_accents, normalize_counts, normalize_term, term_prefixes
+
+MAX_TOKEN_LENGTH = 64 # longer tokens (for example, embedded data) are split between chunks
+
+"""
+Returns the position where the word that contains the position given starts, so the word isn't split
+between two scans. Words longer than MAX_TOKEN_LENGTH are split anyway.
+"""
+def word_start(text, position):
+    if position <= 0 or position >= len(text) or not is_word_char(text[position]):
+        return position
+    start = position
+    while start > 0 and is_word_char(text[start - 1]):
+        start -= 1
+        if position - start > MAX_TOKEN_LENGTH:
+            return position
+    return start
+
+"""
+Returns if the character is part of a word, as \w in the regular expressions.
+"""
+def is_word_char(char):
+    return char.isalnum() or char == "_"
+
+"""
+Compiles the terms as a single regular expression. It starts with the set of the first characters of the
+terms, so the engine can skip quickly the positions where no term starts, and then continues with the
+rest of every term grouped by its first character (the first level of a trie), longest first.
+If whole_words is True, the terms are the beginnings of the words and the rest of the word is matched too.
+"""
+def compile_terms(terms, word_boundary, whole_words=False):
+    if len(terms) == 0:
+        return re.compile(r"(?!)") # never matches
+    by_first_char = {} # { first character : [rest of the terms] }
+    for term in terms:
+        by_first_char.setdefault(term[0], []).append(term[1:])
+    branches = []
+    for first_char in sorted(by_first_char):
+        rests = sorted(by_first_char[first_char], key=lambda rest: (-len(rest), rest))
+        branches.append("(?<=" + re.escape(first_char) + ")(?:" + "|".join(map(re.escape, rests)) + ")")
+    pattern = "[" + "".join(map(re.escape, sorted(by_first_char))) + "]"
+    if word_boundary:
+        pattern += r"(?<!\w.)" # the character before the term isn't part of a word
+    pattern += "(?:" + "|".join(branches) + ")"
+    if whole_words:
+        pattern += r"\w*"
+    elif word_boundary:
+        pattern += r"(?!\w)"
+    return re.compile(pattern, re.DOTALL)
+
+"""
+Base of the streams. Keeps the part of the text that can't be scanned yet, until more text arrives.
+"""
+class ChunkStream:
+    def __init__(self, normalize):
+        self.normalize = normalize
+        self.pending = "" # text received but not scanned yet
+        self.context = "" # last scanned character, needed to know if a word starts at the pending text
+        self.closed = False
+
+    """
+    Scans the chunk given. Can be called any amount of times before close().
+    """
+    def feed(self, chunk):
+        if self.closed:
+            raise ValueError("The stream was already closed")
+        text = self.context + self.pending + self.normalize(chunk)
+        scanned = self.scan(text, len(self.context), final=False)
+        self.context = text[scanned - 1:scanned] if scanned > 0 else ""
+        self.pending = text[scanned:]
+
+    """
+    Scans the rest of the text and returns the counts.
+    """
+    def close(self):
+        if not self.closed:
+            text = self.context + self.pending
+            self.scan(text, len(self.context), final=True)
+            self.pending = ""
+            self.closed = True
+        return self.counts()
+
+    """
+    Counts the matches of text from the position start. If final is False, the matches that may continue
+    in the next chunk are not counted. Returns the position until which the text was scanned.
+    """
+    def scan(self, text, start, final):
+        raise NotImplementedError
+
+    """
+    Returns the counts of the stream.
+    """
+    def counts(self):
+        raise NotImplementedError
+
+"""
+Counts the terms of a TermMatcher in a text stream.
+"""
+class MatchStream(ChunkStream):
+    def __init__(self, matcher, count_length):
+        super().__init__(matcher.normalize)
+        self.matcher = matcher
+        self.count_length = count_length
+        self.found = Counter() # { normalized term : count }
+        self.length = 0 # amount of tokens scanned, only if count_length
+
+    def scan(self, text, start, final):
+        # A match close to the end of the text may be different (or longer) with the next chunk
+        safe_end = len(text) if final else len(text) - self.matcher.longest_term
+        scanned = max(start, safe_end)
+        counted_end = start
+        for match in self.matcher.pattern.finditer(text, start):
+            if not final and (match.start() > safe_end or match.end() >= len(text)):
+                scanned = min(scanned, match.start())
+                break
+            self.found[match.group()] += 1
+            counted_end = match.end()
+            scanned = max(scanned, counted_end)
+        if not final:
+            scanned = max(counted_end, word_start(text, scanned))
+        if self.count_length:
+            self.length += len(TOKEN_PATTERN.findall(text, start, scanned))
+        return scanned
+
+    def counts(self):
+        if self.matcher.stemmed:
+            found = Counter()
+            for word, count in self.found.items():
+                found[normalize_term(word)] += count # words that only start like a term are ignored
+        else:
+            found = self.found
+        return {term: found[normalized] for term, normalized in self.matcher.terms.items()
+                if found[normalized] > 0}
+
+"""
+Multiple term matcher compiled once per query. terms is a list of terms (for example, the words of the
+query). If word_boundary is True, only whole words are counted, so "pan" isn't counted in "panamá".
+If stemmed is True, the terms are the ones of text_analysis.normalize_term and every word whose term
+is one of them is counted (always whole words).
+"""
+class TermMatcher:
+    def __init__(self, terms, word_boundary=True, accent_insensitive=True, stemmed=False):
+        self.accent_insensitive = accent_insensitive
+        self.stemmed = stemmed
+        self.terms = {} # { term : normalized term }
+        for term in terms:
+            normalized = self.normalize(term)
+            if normalized.strip() != "":
+                self.terms[term] = normalized
+        if stemmed:
+            prefixes = {prefix for term in self.terms.values() for prefix in term_prefixes(term)}
+        else:
+            prefixes = set(self.terms.values())
+        self.longest_term = max([len(prefix) for prefix in prefixes], default=0)
+        self.pattern = compile_terms(prefixes, word_boundary or stemmed, whole_words=stemmed)
+
+    """
+    Normalizes the text the same way the terms were normalized.
+    """
+    def normalize(self, text):
+        text = text.lower()
+        return fold_accents(text) if self.accent_insensitive else text
+
+    """
+    Returns a new stream to count the terms in a text received in chunks. If count_length is True, the
+    stream also counts the tokens of the text in its length attribute (needs another scan).
+    """
+    def stream(self, count_length=False):
+        return MatchStream(self, count_length)
+
+    """
+    Returns the count {term: count} of the terms in the text given. Terms that don't appear are not included.
+    """
+    def count(self, text):
+        stream = self.stream()
+        stream.feed(text)
+        return stream.close()
+
+"""
+Counts every term of a text stream, as text_analysis.count_terms does with a complete text.
+"""
+class TokenCounter(ChunkStream):
+    def __init__(self):
+        super().__init__(str.lower)
+        self.found = Counter()
+
+    def scan(self, text, start, final):
+        scanned = start
+        for match in TOKEN_PATTERN.finditer(text, start):
+            if not final and match.end() >= len(text) and match.end() - match.start() < MAX_TOKEN_LENGTH:
+                return match.start() # the token may continue in the next chunk
+            self.found[match.group()] += 1
+            scanned = match.end()
+        return len(text) if final else max(scanned, start)
+
+    def counts(self):
+        return normalize_counts(self.found)
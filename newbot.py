@@ -1,10 +1,17 @@
 """
 Initial code taken from: https://github.com/python-telegram-bot/python-telegram-bot/tree/master/examples
 """
+import asyncio
 import logging
 import os
 from telegram import __version__ as TG_VER
-from retrieval_algorithms import get_query, clean_query, get_relevant_results, get_results
+from retrieval_algorithms import get_query, clean_query, get_relevant_results, get_results, close_client, refresh_site_index
+from top_k import TOP_K
+from place_index import rerank_by_distance
+from resilience import get_host_stats
+from telemetry import METRICS_PORT, finish_trace, increment, span, start_metrics_server, start_trace
+from sessions import sessions
+from cache import places_cache
 try:
     from telegram import __version_info__
 except ImportError:
@@ -29,30 +36,56 @@ from telegram.ext import (
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO,
     filename="logs.txt",
-    filemode="w"
+    filemode="a"
 )
 logger = logging.getLogger(__name__)
-user_info = {}
 FOOD,LOCATION,USER_LOCATION,EXTRA = range(4)
+PROGRESSIVE_RESULTS = os.getenv('PROGRESSIVE_RESULTS', '1') == '1'
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', 2)) # seconds between edits
+HOST_STATS_INTERVAL = int(os.getenv('HOST_STATS_INTERVAL', 60 * 10)) # seconds
+SITE_INDEX_REFRESH_INTERVAL = int(os.getenv('SITE_INDEX_REFRESH_INTERVAL', 60 * 60)) # seconds
+SESSION_PURGE_INTERVAL = int(os.getenv('SESSION_PURGE_INTERVAL', 60 * 10)) # seconds
+searches = {} # { user id : task of the search in progress }
 prices = {"0":"Gratis", "1": "Barato", "2": "Moderado", "3":"Caro", "4":"Muy caro"}
 
 """ 
-Responds to /comenzar call and starts conversation. Creates the user data in the user_info dict.
+Saves the state of the conversation in the session, so it can be resumed after a restart, and returns it.
+"""
+def next_state(session, state):
+    session.state = state
+    sessions.save(session)
+    return state
+
+""" 
+Responds to /comenzar call and starts conversation. Creates the session of the user.
 """
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    user_info[user.id] = {} # { User id : User dict of data }
+    session = sessions.create(user.id)
     await update.message.reply_text(
         "Hola! Soy el bot Coco, me gustaría ayudarte a encontrar un lugar para comer :)\nCuéntame, ¿que te gustaría comer?",
     )
-    return FOOD
+    return next_state(session, FOOD)
+
+""" 
+Returns the session of the user of the conversation. If it expired, asks the user to start again and
+returns None.
+"""
+async def get_session(update):
+    session = sessions.get(update.message.from_user.id)
+    if session is None:
+        await update.message.reply_text("Pasó mucho tiempo desde tu última respuesta. Escribe /comenzar para iniciar de nuevo :)")
+    return session
 
 """ 
 Continue the conversation. It saves the food information in user dict.
 """
 async def food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    user_info[user.id]["food"] = update.message.text
+    session = await get_session(update)
+    if session is None:
+        return ConversationHandler.END
+    session.food = update.message.text
     logger.info(
         "User %s wants to eat: %s", user.first_name, update.message.text
     )
@@ -60,7 +93,7 @@ async def food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Genial! ¿Y en que ubicación te gustaría que esté el restaurante?",
         reply_markup=ReplyKeyboardRemove(),
     )
-    return LOCATION
+    return next_state(session, LOCATION)
 
 """ 
 Continue the conversation. It saves the desired location of the restaurants.
@@ -68,14 +101,17 @@ Continue the conversation. It saves the desired location of the restaurants.
 async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the location and asks for some info about the user."""
     user = update.message.from_user
-    user_info[user.id]["location"] = update.message.text
+    session = await get_session(update)
+    if session is None:
+        return ConversationHandler.END
+    session.location = update.message.text
     logger.info(
         "User %s requested the place to search: %s", user.first_name, update.message.text
     )
     await update.message.reply_text(
         "Muy bien. ¿Te gustaria que tu resultados incluyan las direcciones?\n\nDe ser así, por favor toca el ícono de adjuntar, selecciona ubicación y toca enviar mi ubcación actual.\n\nDe lo contrario, respóndeme un No."
     )
-    return USER_LOCATION
+    return next_state(session, USER_LOCATION)
 
 """ 
 Continue the conversation. Receives user location and saved it
@@ -83,6 +119,9 @@ Continue the conversation. Receives user location and saved it
 async def user_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the location and asks for some info about the user."""
     user = update.message.from_user
+    session = await get_session(update)
+    if session is None:
+        return ConversationHandler.END
     user_location = update.message.location
     logger.info(
         "Location of %s: %f / %f", user.first_name, user_location.latitude, user_location.longitude
@@ -90,32 +129,38 @@ async def user_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text(
         "¡Gracias! Por último, ¿hay detalles extras que te gustaría que tenga el restaurante?"
     )
-    user_info[user.id]["user_location"] = user_location
-    return EXTRA
+    session.latitude, session.longitude = user_location.latitude, user_location.longitude
+    return next_state(session, EXTRA)
 
 """ 
 Continue the conversation. It runs only if user didnt share location
 """
 async def skip_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Skips the location and asks for info about the user."""
-    user = update.message.from_user
+    session = await get_session(update)
+    if session is None:
+        return ConversationHandler.END
     await update.message.reply_text(
         "Entiendo. Por último, ¿hay detalles extras que te gustaría que tenga el restaurante?"
     )
-    user_info[user.id]["user_location"] = None
-    return EXTRA
+    session.latitude, session.longitude = None, None
+    return next_state(session, EXTRA)
 
 """ 
 Continue the conversation. Save extra info of the desired restaurant
 """
 async def extra(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
+    session = await get_session(update)
+    if session is None:
+        return ConversationHandler.END
     if update.message.text.lower() == "si" or update.message.text.lower() == "sí":
         await update.message.reply_text(
         "Perfecto. ¿Cuáles serían?"
         )
         return EXTRA # repeats question
-    user_info[user.id]["extra"] = update.message.text if "no" not in update.message.text.lower() else ""
+    session.extra = update.message.text if "no" not in update.message.text.lower() else ""
+    next_state(session, None) # the search is not repeated after a restart
     logger.info(
         "User %s wants as extras: %s", user.first_name, update.message.text
     )
@@ -123,59 +168,132 @@ async def extra(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Muchas gracias :) Voy a buscar los restaurantes que te puedan servir...",
     )
 
-    # Starts getting the query and getting results
-    results = await process_query(user, update)
+    # Starts getting the query and getting results, in its own task so /cancel can stop it
+    trace = start_trace("search", user=user.id)
+    search = asyncio.ensure_future(answer_query(user, session, update))
+    searches[user.id] = search
+    try:
+        with span("search"):
+            await asyncio.wait({search})
+        if not search.cancelled():
+            search.result() # raises the error of the search, if any
+    finally:
+        if not search.done():
+            search.cancel() # the bot is stopping
+        searches.pop(user.id, None)
+        finish_trace(trace)
+    return ConversationHandler.END
+
+""" 
+Answers the messages received while the search of the user is running. The extra handler doesn't block
+the other updates, so the conversation waits in the WAITING state until the search finishes.
+"""
+async def still_searching(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("Todavía estoy buscando tus restaurantes, espérame un momento :)")
+
+""" 
+Searches the restaurants of the data saved for the user and sends them, or an error message.
+"""
+async def answer_query(user, session, update):
+    progress = {"message": None, "text": None, "sent_at": 0} # provisional results message
+    results = await process_query(user, session, update, progress)
+    increment("coco_searches_total", found=results is not None)
     if results is None:
         error_message = ("No se encontraron resultados para tu búsqueda :("+
                     "\nSi el error persiste, contacta a mi creador: <a href='https://t.me/danisala03'>Daniel Salazar</a>"+
                     "\nDe lo contrario, inténtalo de nuevo! Escribe /comenzar")
-        await update.message.reply_text( 
-            error_message, 
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
+        # Replaces the provisional results, if they were shown
+        await send_final_message(update, progress, error_message)
     else:
         # Results succeeded!
-
+        session.set_ranking(results)
+        sessions.save(session)
         message_with_results = "Tus resultados son los siguientes:\n\n"
-        for i in range(len(results)):
-            if results[i] == None or results[i][1] == None: break # top ended as following values are None
-            
-            # Get price
-            price_status, price_level = get_place_property_from_json("No definido", results[i][1], "price_level")
-            if price_status: price_level = prices[str(price_level)]
-            
-            # Get rating
-            _, rating = get_place_property_from_json("No definido", results[i][1], "rating")
-            
-            # Get if its open
-            sch_status, is_open = get_place_property_from_json("No definido", results[i][1], "opening_hours")
-            if sch_status:
-                op_status, is_open = get_place_property_from_json("No definido", is_open, "open_now")
-                if op_status: is_open = "Abierto" if is_open else "Cerrado"
-            
-            # Get location
-            location = "No definida"
-            if user_info[user.id]["user_location"] != None:
-                geo_status, geometry = get_place_property_from_json("No definida", results[i][1], "geometry")
-                if geo_status: 
-                    loc_status, loc = get_place_property_from_json("No definida", geometry, "location")
-                    if loc_status:
-                        maps_api = "https://www.google.com/maps/dir/?api=1&origin="+str(user_info[user.id]["user_location"].latitude)+","+str(user_info[user.id]["user_location"].longitude)+"&destination="+str(loc["lat"])+","+str(loc["lng"])
-                        location = "<a href='"+maps_api+"'>Ir a la ubicación</a>"
-            
-            # Save restaurant info to show in the top
-            message_with_results +=  ("<b>" + str(i+1) + ")</b>\n<b>Nombre:</b> "+ results[i][1]["name"] + " \n<b>Rating:</b> "
-                                        + str(rating) + " \n<b>Categoría de precios:</b> " + price_level + "\n<b>Estado:</b> "
-                                        + is_open + "\n<b>Ubicación</b> " + location +"\n\n")
+        with span("render"):
+            message_with_results += render_results(results[:TOP_K], session.user_location, 1)
+        if len(results) > TOP_K:
+            message_with_results += "Si quieres ver más resultados, escribe /mas"
 
-        await update.message.reply_text(
-            message_with_results,
-            reply_markup=ReplyKeyboardRemove(),
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
-    return ConversationHandler.END
+        with span("send_results"):
+            await send_final_message(update, progress, message_with_results)
+
+""" 
+Sends the last message of the search. It replaces the provisional results when they were shown, and it is
+sent as a new message if they weren't or the edit failed (the message was deleted, flood limits...).
+"""
+async def send_final_message(update, progress, text):
+    if progress["message"] is not None and await edit_results_message(progress, text):
+        return
+    await update.message.reply_text(
+        text,
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode="HTML",
+        disable_web_page_preview=True
+    )
+
+""" 
+Returns the message with the information of every result given, a list of tuples (weight, result object).
+first_position is the position in the ranking of the first result. If user_location, a tuple (latitude, longitude),
+is not None, adds the link to the directions from the user location to every restaurant.
+"""
+def render_results(results, user_location, first_position):
+    message_with_results = ""
+    for i in range(len(results)):
+        result = results[i][1]
+
+        # Get price
+        price_status, price_level = get_place_property_from_json("No definido", result, "price_level")
+        if price_status: price_level = prices[str(price_level)]
+        
+        # Get rating
+        _, rating = get_place_property_from_json("No definido", result, "rating")
+        
+        # Get if its open
+        sch_status, is_open = get_place_property_from_json("No definido", result, "opening_hours")
+        if sch_status:
+            op_status, is_open = get_place_property_from_json("No definido", is_open, "open_now")
+            if op_status: is_open = "Abierto" if is_open else "Cerrado"
+        
+        # Get location
+        location = "No definida"
+        if user_location != None:
+            geo_status, geometry = get_place_property_from_json("No definida", result, "geometry")
+            if geo_status: 
+                loc_status, loc = get_place_property_from_json("No definida", geometry, "location")
+                if loc_status:
+                    maps_api = "https://www.google.com/maps/dir/?api=1&origin="+str(user_location[0])+","+str(user_location[1])+"&destination="+str(loc["lat"])+","+str(loc["lng"])
+                    location = "<a href='"+maps_api+"'>Ir a la ubicación</a>"
+        
+        # Save restaurant info to show in the top
+        message_with_results +=  ("<b>" + str(first_position + i) + ")</b>\n<b>Nombre:</b> "+ result["name"] + " \n<b>Rating:</b> "
+                                    + str(rating) + " \n<b>Categoría de precios:</b> " + price_level + "\n<b>Estado:</b> "
+                                    + is_open + "\n<b>Ubicación</b> " + location +"\n\n")
+    return message_with_results
+
+""" 
+Responds to /mas call. Shows the next page of results of the last search, without searching again.
+"""
+async def more_results(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.message.from_user
+    session = sessions.get(user.id)
+    if session is None or session.ranking is None:
+        await update.message.reply_text("Aún no has buscado restaurantes. Escribe /comenzar para iniciar :)")
+        return
+    next_page = session.page + 1
+    results = session.ranking[next_page * TOP_K:(next_page + 1) * TOP_K]
+    if len(results) == 0:
+        await update.message.reply_text("No tengo más resultados para tu búsqueda. Escribe /comenzar para buscar de nuevo :)")
+        return
+    session.page = next_page
+    sessions.save(session)
+    message_with_results = "Más resultados:\n\n" + render_results(results, session.user_location, next_page * TOP_K + 1)
+    if len(session.ranking) > (next_page + 1) * TOP_K:
+        message_with_results += "Si quieres ver más resultados, escribe /mas"
+    await update.message.reply_text(
+        message_with_results,
+        parse_mode="HTML",
+        disable_web_page_preview=True
+    )
 
 """ 
 Checks if json result has the property given in param and returns it. If not,
@@ -188,12 +306,18 @@ def get_place_property_from_json(default_value, result, json_property):
         return False, default_value
 
 """ 
-Cancel the conversation.
+Cancel the conversation and the search of the user, if it is running.
 """
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
     user = update.message.from_user
     logger.info("User %s canceled the conversation.", user.first_name)
+    search = searches.get(user.id)
+    if search is not None:
+        search.cancel()
+    session = sessions.get(user.id)
+    if session is not None:
+        next_state(session, None)
     await update.message.reply_text(
         "Hasta luego! Si quieres volver a hablar puedes escribirme /comenzar :)",
         reply_markup=ReplyKeyboardRemove()
@@ -201,31 +325,91 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 """ 
-Process the query. Will use the logic of retrieval_algorithms.py
+Resumes the conversation that the user had in progress when the bot was restarted, with the state saved
+in its session. Messages of users without a conversation in progress are ignored. A location is only
+an answer to the question of the user location; otherwise the user is asked to answer with text.
 """
-async def process_query(user, update):
-    status, query_or_error = clean_query(user_info[user.id]["food"].lower(), 
-                                        user_info[user.id]["location"].lower(), 
-                                        user_info[user.id]["extra"].lower())
+async def resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    session = sessions.get(update.message.from_user.id)
+    if session is None or session.state is None:
+        return ConversationHandler.END
+    if session.state == USER_LOCATION:
+        handler = user_location if update.message.location is not None else skip_location
+    elif update.message.location is not None:
+        await update.message.reply_text("Por favor, respóndeme la última pregunta con un mensaje de texto :)")
+        return session.state
+    else:
+        handler = {FOOD: food, LOCATION: location, EXTRA: extra}[session.state]
+    return await handler(update, context)
+
+""" 
+Edits the message of the results saved in progress with the text given, if it changed. Returns if the
+message has the text given.
+"""
+async def edit_results_message(progress, text):
+    if text == progress["text"]:
+        return True
+    try:
+        await progress["message"].edit_text(text, parse_mode="HTML", disable_web_page_preview=True)
+        progress["text"] = text
+        return True
+    except Exception as e:
+        logger.warning("Error %s editing the results message", repr(e))
+        return False
+
+""" 
+Returns the callback that shows the provisional results to the user while the ranking continues.
+The first time it sends a new message and then edits it, at most once every PROGRESS_EDIT_INTERVAL seconds.
+progress is a dict that keeps the message sent, its text and when it was sent.
+"""
+def get_progress_callback(session, update, progress):
+    async def show_progress(ranking):
+        top = rerank_by_distance(ranking.ranked(), session.user_location)[:TOP_K]
+        now = asyncio.get_running_loop().time()
+        if len(top) == 0 or now - progress["sent_at"] < PROGRESS_EDIT_INTERVAL:
+            return
+        text = ("Estos son mis resultados por ahora, sigo buscando...\n\n"
+                    + render_results(top, session.user_location, 1))
+        progress["sent_at"] = now
+        if progress["message"] is None:
+            progress["message"] = await update.message.reply_text(
+                text,
+                reply_markup=ReplyKeyboardRemove(),
+                parse_mode="HTML",
+                disable_web_page_preview=True
+            )
+            progress["text"] = text
+        else:
+            await edit_results_message(progress, text)
+    return show_progress
+
+""" 
+Process the query. Will use the logic of retrieval_algorithms.py. If PROGRESSIVE_RESULTS is enabled,
+the provisional results are shown while the ranking continues and progress keeps their message.
+If the user shared the location, the results are ordered by their weight and their distance to the user.
+"""
+async def process_query(user, session, update, progress):
+    status, query_or_error = clean_query(session.food.lower(), session.location.lower(), session.extra.lower())
     if not status:
         logger.info("Query was not generated for user %s as the error: %s occured", user.first_name, query_or_error)
         return None
 
     # Query cleaned successfully
-    logger.info("Query generated for user %s is %s", user.first_name, query_or_error)
-    items = get_results(query_or_error, logger, user)
-    if items is None:
-        logger.info("There were not results found for user %s with query %s", user.first_name, query_or_error)
-        return items
+    logger.info("Query generated for user %s is %s with terms %s", user.first_name, query_or_error.text, query_or_error.terms)
+    results_page = await get_results(query_or_error, logger, user, session.user_location)
+    if results_page is None:
+        logger.info("There were not results found for user %s with query %s", user.first_name, query_or_error.text)
+        return None
     else:
         await update.message.reply_text(
-            "Espérame un poco más, aún sigo pensando que podría serte más útil... Podría durar hasta 2 minutos!"
+            "Espérame un poco más, aún sigo pensando que podría serte más útil... Te mostraré lo que vaya encontrando!"
         )
-    relevant_results = get_relevant_results(items, query_or_error, logger, user)
-    if relevant_results is None or relevant_results[0][1] == None: # Error and it was never updated as top 1 has 0 weight
-        logger.info("There were not relevant results found for user %s with query %s", user.first_name, query_or_error)
+    on_progress = get_progress_callback(session, update, progress) if PROGRESSIVE_RESULTS else None
+    relevant_results = await get_relevant_results(results_page, query_or_error, logger, user, on_progress)
+    if relevant_results is None or len(relevant_results) == 0: # Error or no result had weight
+        logger.info("There were not relevant results found for user %s with query %s", user.first_name, query_or_error.text)
         return None
-    return relevant_results # top 5 answers
+    return rerank_by_distance(relevant_results.ranked(), session.user_location) # top answers and the following pages
 
 """ 
 Will guide the user on how to use the bot after they call the command /ayuda
@@ -234,14 +418,80 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id, 
         text="Hola! Mi propósito es ayudarte a encontrar un restaurante que te pueda gustar. Escribe /comenzar y podremos inciar la conversación."
-        +"\n\nVoy a hacerte 3 preguntas breves y esperaré por tus respuestas para buscar resultados relevantes para ti. Como tip, trata de contestar de froma breve y concisa para darte resultados más exactos ;)")
+        +"\n\nVoy a hacerte 3 preguntas breves y esperaré por tus respuestas para buscar resultados relevantes para ti. Como tip, trata de contestar de froma breve y concisa para darte resultados más exactos ;)"
+        +"\n\nCuando te muestre los resultados, escribe /mas para ver los siguientes.")
 
-def main() -> None:
+""" 
+Keeps refreshing the expired websites of the site index while the bot is running.
+"""
+async def site_index_refresher():
+    while True:
+        try:
+            await refresh_site_index(logger)
+        except Exception as e:
+            logger.error("Error %s refreshing the site index", str(e))
+        await asyncio.sleep(SITE_INDEX_REFRESH_INTERVAL)
+
+""" 
+Logs periodically the stats of the hosts that used most of the time of the searches.
+"""
+async def host_stats_reporter():
+    while True:
+        await asyncio.sleep(HOST_STATS_INTERVAL)
+        for host_stats in get_host_stats()[:10]:
+            logger.info("Host stats: %s", host_stats)
+
+""" 
+Removes periodically the sessions of the users that stopped talking to the bot and the expired Place
+API responses of the disk cache.
+"""
+async def session_purger():
+    while True:
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+        try:
+            removed = sessions.purge()
+            logger.info("Removed %d idle sessions. Stats: %s", removed, sessions.stats())
+            places_cache.purge()
+        except Exception as e:
+            logger.error("Error %s removing the idle sessions and the expired responses", str(e))
+
+""" 
+Starts the background jobs of the bot. The site index is only refreshed if refresh_sites, so a single
+process does it when there are several (see webhook.py). The metrics endpoint listens on metrics_port,
+0 disables it.
+"""
+def start_background_jobs(application: Application, refresh_sites=True, metrics_port=METRICS_PORT) -> None:
+    if refresh_sites:
+        application.create_task(site_index_refresher())
+    application.create_task(host_stats_reporter())
+    application.create_task(session_purger())
+    if start_metrics_server(port=metrics_port) is not None:
+        logger.info("Metrics endpoint started on port %d", metrics_port)
+
+""" 
+Starts the background jobs once the application is initialized.
+"""
+async def post_init(application: Application) -> None:
+    start_background_jobs(application)
+
+""" 
+Returns the Application of the bot with every handler, ready to receive the updates by polling
+(run_polling) or from the webhook workers (see webhook.py).
+"""
+def build_application() -> Application:
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(str(os.getenv('BOT_TOKEN'))).build()
+    # The updates are processed one by one, as the ConversationHandler needs. The search runs in a
+    # handler that doesn't block (block=False), so it doesn't delay the other chats.
+    application = (Application.builder()
+                    .token(str(os.getenv('BOT_TOKEN')))
+                    .post_init(post_init)
+                    .post_shutdown(close_client)
+                    .build())
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("comenzar", start),
-                        CommandHandler("start", start)],
+                        CommandHandler("start", start),
+                        # conversations in progress before a restart
+                        MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.LOCATION, resume, block=False)],
         states={
             FOOD: [MessageHandler(filters.TEXT, food)],
             LOCATION: [
@@ -252,7 +502,11 @@ def main() -> None:
                 MessageHandler(filters.TEXT, skip_location),
                 CommandHandler("skip", skip_location),
             ],
-            EXTRA: [MessageHandler(filters.TEXT, extra)],
+            EXTRA: [MessageHandler(filters.TEXT & ~filters.COMMAND, extra, block=False)],
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cancel),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, still_searching),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
@@ -260,9 +514,12 @@ def main() -> None:
     application.add_handler(conv_handler)
     help_handl = CommandHandler('ayuda', help_handler)
     application.add_handler(help_handl)
+    application.add_handler(CommandHandler('mas', more_results))
+    return application
 
+def main() -> None:
     # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    build_application().run_polling()
 
 
 if __name__ == "__main__":
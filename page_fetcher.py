@@ -0,0 +1,92 @@
+"""
+Streaming download of the restaurant pages. The body is read in chunks: only pages with a text content
+type are read, the download stops after MAX_PAGE_BYTES and the HTML is converted to visible text while it
+arrives (without tags, scripts or styles). The text is fed to a sink, any object with feed(text), such as
+the streams of matcher.py, so the complete page is never kept in memory.
+"""
+import codecs
+import os
+from html.parser import HTMLParser
+
+MAX_PAGE_BYTES = int(os.getenv('MAX_PAGE_BYTES', 2 * 1024 * 1024))
+TEXT_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+# Tags whose content isn't visible text
+HIDDEN_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "object"}
+# Tags that separate words, even if there are no spaces around them in the HTML
+BLOCK_TAGS = {"p", "div", "br", "li", "td", "th", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "span", "a",
+              "section", "article", "header", "footer", "nav", "ul", "ol", "table", "option", "button",
+              "title", "label"}
+
+"""
+Incremental HTML parser that feeds only the visible text of the page to the sink.
+"""
+class TextExtractor(HTMLParser):
+    def __init__(self, sink):
+        super().__init__(convert_charrefs=True)
+        self.sink = sink
+        self.hidden_depth = 0 # > 0 inside a hidden tag
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.sink.feed(" ")
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth = max(0, self.hidden_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.sink.feed(" ")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.sink.feed(" ")
+
+    def handle_data(self, data):
+        if self.hidden_depth == 0:
+            self.sink.feed(data)
+
+"""
+Returns the content type of the response, without parameters such as the charset.
+"""
+def get_content_type(response):
+    return response.headers.get("content-type", "text/html").split(";")[0].strip().lower()
+
+"""
+Returns the incremental decoder of the encoding of the response. Invalid bytes are replaced.
+"""
+def get_decoder(response):
+    try:
+        return codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+"""
+Makes the GET request of the url and feeds the visible text of the body to the sink while it downloads.
+Reads at most max_bytes of the body. Returns the response, whose body must not be read again. If the
+site answers 304 Not Modified, nothing is fed. Raises an exception if the status isn't successful or the
+content isn't text (images, PDFs, etc).
+"""
+async def fetch_text(client, url, sink, headers=None, max_bytes=MAX_PAGE_BYTES):
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code == 304:
+            return response
+        response.raise_for_status()
+        content_type = get_content_type(response)
+        if content_type not in TEXT_CONTENT_TYPES:
+            raise ValueError("Content type " + content_type + " of " + url + " is not text")
+
+        decoder = get_decoder(response)
+        extractor = TextExtractor(sink) if content_type != "text/plain" else sink
+        read_bytes = 0
+        async for chunk in response.aiter_bytes():
+            chunk = chunk[:max_bytes - read_bytes]
+            read_bytes += len(chunk)
+            extractor.feed(decoder.decode(chunk))
+            if read_bytes >= max_bytes:
+                break # the rest of the page is ignored
+        extractor.feed(decoder.decode(b"", final=True))
+        if extractor is not sink:
+            extractor.close()
+        return response
@@ -0,0 +1,134 @@
+"""
+Store of the pages fetched to calculate the ranking. Instead of the HTML, it saves the term frequency
+of every page along with the ETag and Last-Modified headers, so a page can be reused without fetching
+it again while it is fresh, or revalidated with a conditional GET afterwards.
+"""
+import json
+import os
+import time
+from collections import OrderedDict, namedtuple
+from cache import CACHE_DB_PATH, get_connection
+from text_analysis import ANALYZER_VERSION
+
+PAGE_STORE_TTL = int(os.getenv('PAGE_STORE_TTL', 60 * 60 * 24)) # seconds a page is fresh, 0 disables it
+PAGE_STORE_MEMORY_SIZE = int(os.getenv('PAGE_STORE_MEMORY_SIZE', 512)) # pages kept in memory
+# The terms saved by another version of the text analysis are not comparable, so every version has its table
+PAGES_TABLE = "pages_v" + str(ANALYZER_VERSION)
+
+# terms is a dictionary {term: count} and length the total amount of terms of the page
+PageEntry = namedtuple("PageEntry", ["url", "terms", "length", "etag", "last_modified", "fetched_at"])
+
+"""
+Term frequency store keyed by URL. The most recently used pages are also kept in memory.
+"""
+class PageStore:
+    def __init__(self, path=CACHE_DB_PATH, ttl=PAGE_STORE_TTL, max_entries=PAGE_STORE_MEMORY_SIZE):
+        self.ttl = ttl
+        self.enabled = ttl > 0
+        self.max_entries = max_entries
+        self.memory = OrderedDict() # { url : PageEntry }
+        self.fresh_hits = 0
+        self.revalidations = 0
+        self.downloads = 0
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {PAGES_TABLE} (url TEXT PRIMARY KEY, terms TEXT, length INTEGER, "
+                "etag TEXT, last_modified TEXT, fetched_at REAL)"
+            )
+
+    """
+    Returns the PageEntry saved for the url, even if it is not fresh, or None if it was never saved.
+    """
+    def get(self, url):
+        if url in self.memory:
+            self.memory.move_to_end(url)
+            return self.memory[url]
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            f"SELECT url, terms, length, etag, last_modified, fetched_at FROM {PAGES_TABLE} WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = PageEntry(row[0], json.loads(row[1]), row[2], row[3], row[4], row[5])
+        self._remember(entry)
+        return entry
+
+    """
+    Returns if the entry can be used without asking the site if the page changed.
+    """
+    def is_fresh(self, entry):
+        return time.time() - entry.fetched_at < self.ttl
+
+    """
+    Returns the headers needed to make a conditional GET request for the entry.
+    """
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    """
+    Saves the term frequency of the page and its validation headers. Returns the new PageEntry.
+    """
+    def save(self, url, terms, etag=None, last_modified=None):
+        entry = PageEntry(url, terms, sum(terms.values()), etag, last_modified, time.time())
+        self._remember(entry)
+        if self.connection is not None:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {PAGES_TABLE} (url, terms, length, etag, last_modified, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, json.dumps(terms), entry.length, etag, last_modified, entry.fetched_at)
+            )
+        return entry
+
+    """
+    Marks the entry as fresh again. Used when the site answered that the page didn't change.
+    """
+    def touch(self, entry):
+        entry = entry._replace(fetched_at=time.time())
+        self._remember(entry)
+        if self.connection is not None:
+            self.connection.execute(
+                f"UPDATE {PAGES_TABLE} SET fetched_at = ? WHERE url = ?", (entry.fetched_at, entry.url)
+            )
+        return entry
+
+    """
+    Yields every saved page as a tuple (url, {term: count}). Used to build the inverted index.
+    """
+    def pages(self):
+        if self.connection is None:
+            for entry in list(self.memory.values()):
+                yield entry.url, entry.terms
+            return
+        for url, terms in self.connection.execute(f"SELECT url, terms FROM {PAGES_TABLE} ORDER BY url"):
+            yield url, json.loads(terms)
+
+    """
+    Returns the counters of the store as a dictionary.
+    """
+    def stats(self):
+        return {
+            "entries": len(self.memory),
+            "fresh_hits": self.fresh_hits,
+            "revalidations": self.revalidations,
+            "downloads": self.downloads,
+        }
+
+    """
+    Saves the entry in memory and evicts the least recently used page if it is full.
+    """
+    def _remember(self, entry):
+        self.memory[entry.url] = entry
+        self.memory.move_to_end(entry.url)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+page_store = PageStore()
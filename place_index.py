@@ -0,0 +1,233 @@
+"""
+Spatial index of every restaurant seen in the Place API responses, with its location, rating, price and
+the terms it is known for (the terms of its name and of the searches that returned it). The places are
+kept in a grid of cells of PLACE_INDEX_CELL degrees, so the places near a location are found by reading
+only the cells around it, and saved in SQLite so the index grows between restarts.
+
+It is used to answer the searches of restaurants near the user (the user shared the location and the
+place answered was only words like "cerca" or "aquí") without calling the Place API, when enough known
+places are close, and to rerank the results of a search mixing their weight and their distance.
+"""
+import math
+import os
+import time
+import numpy as np
+from collections import defaultdict, namedtuple
+from cache import CACHE_DB_PATH, get_connection
+from text_analysis import count_terms
+
+PLACE_INDEX_TTL = int(os.getenv('PLACE_INDEX_TTL', 60 * 60 * 24 * 30)) # seconds a place is used without being seen again
+PLACE_INDEX_CELL = float(os.getenv('PLACE_INDEX_CELL', 0.01)) # degrees of the side of a cell, about 1.1 km
+NEARBY_RADIUS = float(os.getenv('NEARBY_RADIUS', 2000)) # meters
+NEARBY_MIN_PLACES = int(os.getenv('NEARBY_MIN_PLACES', 10)) # known places near the user to skip the Place API
+NEARBY_MAX_PLACES = int(os.getenv('NEARBY_MAX_PLACES', 20)) # places of a local answer, as a page of the API
+DISTANCE_WEIGHT = float(os.getenv('DISTANCE_WEIGHT', 0.3)) # part of the distance in the order, 0 ignores it
+
+EARTH_RADIUS = 6371000 # meters
+METERS_PER_DEGREE = 111320 # of latitude
+
+# terms is a frozenset of the terms the place is known for
+PlaceEntry = namedtuple("PlaceEntry", ["place_id", "name", "latitude", "longitude", "rating", "price_level",
+                                       "terms", "seen_at"])
+
+"""
+Returns the location of the Place API result as a tuple (latitude, longitude), or None.
+"""
+def get_location(result):
+    location = result.get("geometry", {}).get("location")
+    if location is None or "lat" not in location or "lng" not in location:
+        return None
+    return float(location["lat"]), float(location["lng"])
+
+"""
+Returns the distance in meters (haversine) from the origin, a tuple (latitude, longitude), to every
+point of the arrays of latitudes and longitudes given.
+"""
+def get_distances(latitudes, longitudes, origin):
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    origin_latitude, origin_longitude = math.radians(origin[0]), math.radians(origin[1])
+    a = (np.sin((latitudes - origin_latitude) / 2) ** 2
+         + math.cos(origin_latitude) * np.cos(latitudes) * np.sin((longitudes - origin_longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+"""
+Returns the ranking given, a list of tuples (weight, result object), ordered by a mix of the weight and
+the distance from user_location, a tuple (latitude, longitude). The weights are divided by the highest
+one and the distances become a closeness from 1 (same place) to 0 (far away), that halves every
+radius meters. Results without location have closeness 0. Ties keep their order. The tuples aren't
+changed, so the weights are still the ones of the pages. Without user_location or distance_weight, the
+ranking is returned as it is.
+"""
+def rerank_by_distance(ranking, user_location, distance_weight=DISTANCE_WEIGHT, radius=NEARBY_RADIUS):
+    if user_location is None or distance_weight <= 0 or len(ranking) < 2:
+        return ranking
+    weights = np.array([weight for weight, _ in ranking], dtype=np.float64)
+    locations = [get_location(result) for _, result in ranking]
+    known = np.array([location is not None for location in locations])
+    latitudes = np.array([location[0] if location else 0.0 for location in locations])
+    longitudes = np.array([location[1] if location else 0.0 for location in locations])
+    closeness = np.where(known, 0.5 ** (get_distances(latitudes, longitudes, user_location) / radius), 0.0)
+    relevance = weights / weights.max() if weights.max() > 0 else weights
+    score = (1 - distance_weight) * relevance + distance_weight * closeness
+    return [ranking[i] for i in np.argsort(-score, kind="stable")]
+
+"""
+Index {place_id: PlaceEntry} saved in SQLite and kept in memory, with the grid {cell: place_ids}. The
+terms are rows of their own table, so the terms saved by other processes are merged and not replaced,
+and the area around a location is read again from SQLite when the memory doesn't have enough places.
+"""
+class PlaceIndex:
+    def __init__(self, path=CACHE_DB_PATH, ttl=PLACE_INDEX_TTL, cell_size=PLACE_INDEX_CELL):
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.entries = {} # { place_id : PlaceEntry }
+        self.cells = defaultdict(set) # { (row, column) : set of place_id }
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS places (place_id TEXT PRIMARY KEY, name TEXT, latitude REAL, "
+                "longitude REAL, rating REAL, price_level INTEGER, seen_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS places_latitude ON places (latitude)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS place_terms (place_id TEXT, term TEXT, PRIMARY KEY (place_id, term))"
+            )
+            self._load("", ())
+
+    def __len__(self):
+        return len(self.entries)
+
+    """
+    Returns the cell of the location, as a tuple (row, column).
+    """
+    def get_cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    """
+    Returns the name of the cell of the location, used to share the work of the users in the same area.
+    """
+    def get_area(self, location):
+        return "%d:%d" % self.get_cell(*location)
+
+    """
+    Saves the places of the Place API results, returned for a search with the terms given. Places
+    seen again keep the terms of the previous searches. Places closed permanently are removed.
+    """
+    def save_results(self, results, terms):
+        now = time.time()
+        rows = []
+        term_rows = []
+        for result in results:
+            place_id = result.get("place_id")
+            location = get_location(result)
+            if place_id is None or location is None or "name" not in result:
+                continue
+            if result.get("business_status") == "CLOSED_PERMANENTLY":
+                self.delete(place_id)
+                continue
+            previous = self.entries.get(place_id)
+            new_terms = frozenset(terms) | frozenset(count_terms(result["name"]))
+            place_terms = new_terms | previous.terms if previous is not None else new_terms
+            entry = PlaceEntry(place_id, result["name"], location[0], location[1], result.get("rating"),
+                               result.get("price_level"), place_terms, now)
+            self._add(entry)
+            rows.append(entry[:6] + (now,))
+            term_rows.extend((place_id, term) for term in new_terms)
+        if self.connection is not None and len(rows) > 0:
+            self.connection.executemany(
+                "INSERT INTO places (place_id, name, latitude, longitude, rating, price_level, seen_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (place_id) DO UPDATE SET name = excluded.name, "
+                "latitude = excluded.latitude, longitude = excluded.longitude, rating = excluded.rating, "
+                "price_level = excluded.price_level, seen_at = excluded.seen_at", rows
+            )
+            self.connection.executemany("INSERT OR IGNORE INTO place_terms (place_id, term) VALUES (?, ?)", term_rows)
+
+    def delete(self, place_id):
+        entry = self.entries.pop(place_id, None)
+        if entry is not None:
+            self.cells[self.get_cell(entry.latitude, entry.longitude)].discard(place_id)
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM places WHERE place_id = ?", (place_id,))
+            self.connection.execute("DELETE FROM place_terms WHERE place_id = ?", (place_id,))
+
+    """
+    Returns the known places at most radius meters away from the location, a tuple (latitude, longitude),
+    that are known for some of the terms given, as Place API results. At most limit of them, the
+    closest first. Places not seen for longer than the TTL are ignored. If the memory doesn't have limit
+    places, the cells are read again from SQLite, where other processes may have saved more.
+    """
+    def nearby(self, terms, location, radius=NEARBY_RADIUS, limit=NEARBY_MAX_PLACES):
+        terms = frozenset(terms)
+        limit_time = time.time() - self.ttl
+        latitude_cells = math.ceil(radius / METERS_PER_DEGREE / self.cell_size)
+        longitude_cells = math.ceil(radius / (METERS_PER_DEGREE * max(math.cos(math.radians(location[0])), 0.01))
+                                    / self.cell_size)
+        row, column = self.get_cell(*location)
+        rows = range(row - latitude_cells, row + latitude_cells + 1)
+        columns = range(column - longitude_cells, column + longitude_cells + 1)
+        candidates = self._candidates(terms, rows, columns, limit_time)
+        if len(candidates) < limit and self.connection is not None:
+            self._load("WHERE latitude >= ? AND latitude < ? AND longitude >= ? AND longitude < ? AND seen_at >= ?",
+                       (rows.start * self.cell_size, rows.stop * self.cell_size,
+                        columns.start * self.cell_size, columns.stop * self.cell_size, limit_time))
+            candidates = self._candidates(terms, rows, columns, limit_time)
+        if len(candidates) == 0:
+            return []
+        distances = get_distances([entry.latitude for entry in candidates],
+                                  [entry.longitude for entry in candidates], location)
+        closest = [i for i in np.argsort(distances, kind="stable") if distances[i] <= radius][:limit]
+        return [self.to_result(candidates[i]) for i in closest]
+
+    """
+    Returns the entry as a Place API result, with the fields used by the ranking and to show it.
+    """
+    @staticmethod
+    def to_result(entry):
+        result = {"place_id": entry.place_id, "name": entry.name,
+                  "geometry": {"location": {"lat": entry.latitude, "lng": entry.longitude}}}
+        if entry.rating is not None:
+            result["rating"] = entry.rating
+        if entry.price_level is not None:
+            result["price_level"] = entry.price_level
+        return result
+
+    def stats(self):
+        return {"entries": len(self.entries), "cells": sum(1 for places in self.cells.values() if len(places) > 0)}
+
+    """
+    Returns the entries of the cells given, seen after limit_time, that are known for some of the terms.
+    """
+    def _candidates(self, terms, rows, columns, limit_time):
+        candidates = []
+        for cell_row in rows:
+            for cell_column in columns:
+                for place_id in self.cells.get((cell_row, cell_column), ()):
+                    entry = self.entries[place_id]
+                    if entry.seen_at >= limit_time and not terms.isdisjoint(entry.terms):
+                        candidates.append(entry)
+        return candidates
+
+    """
+    Reads the places of SQLite that match the condition given, with their terms, and keeps them in memory.
+    """
+    def _load(self, condition, parameters):
+        rows = self.connection.execute(
+            "SELECT places.place_id, name, latitude, longitude, rating, price_level, group_concat(term, ' '), "
+            "seen_at FROM places LEFT JOIN place_terms ON place_terms.place_id = places.place_id "
+            + condition + " GROUP BY places.place_id", parameters
+        )
+        for row in rows:
+            self._add(PlaceEntry(*row[:6], frozenset((row[6] or "").split()), row[7]))
+
+    """
+    Keeps the entry in memory and in the cell of its location.
+    """
+    def _add(self, entry):
+        previous = self.entries.get(entry.place_id)
+        if previous is not None:
+            self.cells[self.get_cell(previous.latitude, previous.longitude)].discard(entry.place_id)
+        self.entries[entry.place_id] = entry
+        self.cells[self.get_cell(entry.latitude, entry.longitude)].add(entry.place_id)
+
+place_index = PlaceIndex()
@@ -0,0 +1,181 @@
+"""
+Shared scheduler of the calls to the Google APIs. Every API has a token bucket, that limits the calls per
+second of every user together, and a daily quota budget. The calls waiting for a token are served by
+priority, so the first page of Place API results of a user that is waiting goes before the next pages
+and the Custom Search lookups of the restaurant websites.
+
+Under pressure (the daily budget is almost spent or the calls waiting would take too long), the calls of the lowest
+priorities are refused at once with QuotaExceededError, so the pipeline can degrade (use cached data,
+skip the website lookups) instead of failing. The usage of the day is saved in SQLite, so it survives
+restarts and is shared by every process using the same file.
+"""
+import asyncio
+import heapq
+import os
+import time
+from datetime import datetime, timezone
+from cache import CACHE_DB_PATH, get_connection
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo(os.getenv('QUOTA_TIMEZONE', 'America/Los_Angeles')) # Google resets the quotas at midnight there
+except Exception:
+    QUOTA_TIMEZONE = timezone.utc
+
+PLACES_RATE = float(os.getenv('PLACES_RATE', 10)) # calls per second
+PLACES_DAILY_QUOTA = int(os.getenv('PLACES_DAILY_QUOTA', 0)) # calls per day, 0 is unlimited
+SEARCH_RATE = float(os.getenv('SEARCH_RATE', 5))
+SEARCH_DAILY_QUOTA = int(os.getenv('SEARCH_DAILY_QUOTA', 100)) # free quota of the Custom Search API
+QUOTA_RESERVE = float(os.getenv('QUOTA_RESERVE', 0.1)) # part of the daily quota kept for the first pages
+BACKGROUND_RESERVE = float(os.getenv('BACKGROUND_RESERVE', 0.5)) # part of the daily quota background jobs can't use
+# seconds a new call would wait for a token before the low priorities are refused, 0 never refuses them.
+# By default half the time budget of the ranking, so a website found late still has time to be fetched
+MAX_QUEUE_WAIT = float(os.getenv('MAX_QUEUE_WAIT', float(os.getenv('RANKING_TIME_BUDGET', 20)) / 2))
+
+# Priorities, the lowest first
+FIRST_PAGE, NEXT_PAGE, ENRICHMENT, BACKGROUND = range(4)
+DEGRADABLE = NEXT_PAGE # priorities refused under pressure
+
+"""
+Raised when a call is not made because the quota is spent or the API is under pressure.
+"""
+class QuotaExceededError(Exception):
+    def __init__(self, api, reason):
+        super().__init__("Quota of " + api + " not available: " + reason)
+        self.api = api
+        self.reason = reason
+
+"""
+Returns the day of the quota, as "YYYY-MM-DD".
+"""
+def get_quota_day():
+    return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+"""
+Calls made to every API per day, saved in SQLite if the disk tier is enabled.
+"""
+class QuotaUsage:
+    def __init__(self, path=CACHE_DB_PATH):
+        self.memory = {} # { (api, day) : calls }, used without disk tier
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS quota_usage (api TEXT, day TEXT, used INTEGER, PRIMARY KEY (api, day))"
+            )
+
+    def used(self, api):
+        day = get_quota_day()
+        if self.connection is None:
+            return self.memory.get((api, day), 0)
+        row = self.connection.execute("SELECT used FROM quota_usage WHERE api = ? AND day = ?", (api, day)).fetchone()
+        return row[0] if row is not None else 0
+
+    def add(self, api, calls=1):
+        day = get_quota_day()
+        if self.connection is None:
+            self.memory[(api, day)] = self.memory.get((api, day), 0) + calls
+            return
+        self.connection.execute(
+            "INSERT INTO quota_usage (api, day, used) VALUES (?, ?, ?) "
+            "ON CONFLICT (api, day) DO UPDATE SET used = used + excluded.used", (api, day, calls)
+        )
+
+"""
+Token bucket and priority queue of a single API.
+"""
+class ApiScheduler:
+    def __init__(self, name, rate, daily_quota, usage, burst=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.daily_quota = daily_quota
+        self.usage = usage
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.waiting = [] # heap of (priority, arrival, future)
+        self.arrivals = 0
+        self.dispatcher = None
+        self.granted = 0
+        self.refused = 0
+
+    """
+    Returns the calls left today, or None if the quota is unlimited.
+    """
+    def remaining(self):
+        if self.daily_quota <= 0:
+            return None
+        return max(0, self.daily_quota - self.usage.used(self.name))
+
+    """
+    Returns if the calls of the priority given should be avoided: the daily quota is almost spent or the
+    calls waiting for a token need more than MAX_QUEUE_WAIT seconds at the rate of the API. The background calls stop much sooner, when BACKGROUND_RESERVE of
+    the daily quota is left, so they never use the quota of the users.
+    """
+    def under_pressure(self, priority=ENRICHMENT):
+        remaining = self.remaining()
+        reserve = BACKGROUND_RESERVE if priority >= BACKGROUND else QUOTA_RESERVE
+        if remaining is not None and remaining <= self.daily_quota * reserve:
+            return True
+        return MAX_QUEUE_WAIT > 0 and len(self.waiting) / self.rate >= MAX_QUEUE_WAIT
+
+    """
+    Waits until the call can be made, after the calls of higher priority. Raises QuotaExceededError if the
+    daily quota is spent or if the priority can be degraded and the API is under pressure.
+    """
+    async def acquire(self, priority):
+        remaining = self.remaining()
+        if remaining == 0:
+            self.refused += 1
+            raise QuotaExceededError(self.name, "daily quota spent")
+        if priority >= DEGRADABLE and self.under_pressure(priority):
+            self.refused += 1
+            raise QuotaExceededError(self.name, "under pressure")
+
+        future = asyncio.get_running_loop().create_future()
+        self.arrivals += 1
+        heapq.heappush(self.waiting, (priority, self.arrivals, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self.dispatch())
+        await future # cancelled waiters are skipped by the dispatcher
+        self.granted += 1
+        self.usage.add(self.name)
+
+    """
+    Gives the tokens to the waiting calls, the highest priority first, until none is waiting.
+    """
+    async def dispatch(self):
+        while len(self.waiting) > 0:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            while self.tokens >= 1 and len(self.waiting) > 0:
+                _, _, future = heapq.heappop(self.waiting)
+                if not future.done():
+                    future.set_result(None)
+                    self.tokens -= 1
+            if len(self.waiting) > 0:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    """
+    Counts a call made without acquire, as the duplicate of a hedged request, which uses quota too.
+    """
+    def charge(self):
+        self.granted += 1
+        self.usage.add(self.name)
+
+    """
+    Divides the rate between the processes given, as every process that calls the API with the same key
+    has its own scheduler. The daily quota is already shared through the database.
+    """
+    def share(self, processes):
+        self.rate = self.rate / processes
+        self.burst = max(1.0, self.burst / processes)
+        self.tokens = min(self.tokens, self.burst)
+
+    def stats(self):
+        return {"api": self.name, "waiting": len(self.waiting), "granted": self.granted, "refused": self.refused,
+                "remaining": self.remaining()}
+
+usage = QuotaUsage()
+places_scheduler = ApiScheduler("places", PLACES_RATE, PLACES_DAILY_QUOTA, usage)
+search_scheduler = ApiScheduler("search", SEARCH_RATE, SEARCH_DAILY_QUOTA, usage)
@@ -0,0 +1,238 @@
+"""
+Resilience of the outbound requests. Keeps the latency and the errors of every host and uses them to:
+    - Stop calling a host that keeps failing for a while (circuit breaker), instead of waiting for its
+      timeout on every search. Only timeouts, connection errors and 5xx answers are failures of the
+      host; a 404 or a page that isn't text is a problem of the page. The hosts of the Google APIs are
+      exempted (see exempt_from_circuit), as every search needs them.
+    - Limit every request to a timeout derived from the p95 latency of its host.
+    - Send a duplicated (hedged) request when the first one takes longer than usual. Only used for the
+      Google APIs, whose requests are idempotent and cheap to repeat.
+The stats of every host can be exported with get_host_stats().
+"""
+import asyncio
+import httpx
+import os
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+LATENCY_SAMPLES = 100 # latencies kept per host to calculate the percentiles
+DEFAULT_TIMEOUT = float(os.getenv('DEFAULT_TIMEOUT', 3)) # seconds, until there are enough samples
+MIN_TIMEOUT = float(os.getenv('MIN_TIMEOUT', 1))
+MAX_TIMEOUT = float(os.getenv('MAX_TIMEOUT', 6))
+TIMEOUT_P95_FACTOR = float(os.getenv('TIMEOUT_P95_FACTOR', 2))
+MIN_SAMPLES = 5 # samples needed to derive the timeout
+
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', 3)) # consecutive failures to open the circuit
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 60 * 10))
+
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.3)) # seconds before the hedged request
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+"""
+Raised when a request is not made because the circuit of its host is open.
+"""
+class CircuitOpenError(Exception):
+    def __init__(self, host):
+        super().__init__("Circuit open for host " + host)
+        self.host = host
+
+"""
+Latency, errors and circuit breaker of a single host.
+"""
+class HostStats:
+    def __init__(self, host):
+        self.host = host
+        self.latencies = deque(maxlen=LATENCY_SAMPLES) # seconds of the successful requests
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0 # requests not made as the circuit was open
+        self.hedged = 0 # duplicated requests sent
+        self.time_spent = 0.0 # seconds waiting for this host, successful or not
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_at = 0.0 # when the request that tests a half open circuit was sent
+
+    """
+    Returns if a request can be made to the host. After CIRCUIT_OPEN_SECONDS, an open circuit lets a
+    single request through (half open) and its result decides if it closes or opens again. The other
+    requests are rejected meanwhile, unless that request was lost for longer than MAX_TIMEOUT.
+    """
+    def allow_request(self):
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= CIRCUIT_OPEN_SECONDS:
+            self.state = HALF_OPEN
+            self.probe_at = 0.0
+        if self.state == OPEN or (self.state == HALF_OPEN and now - self.probe_at < MAX_TIMEOUT):
+            self.rejected += 1
+            return False
+        if self.state == HALF_OPEN:
+            self.probe_at = now
+        return True
+
+    def record_success(self, latency):
+        self.successes += 1
+        self.time_spent += latency
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+
+    def record_failure(self, latency):
+        self.failures += 1
+        self.time_spent += latency
+        self.consecutive_failures += 1
+        if self.host in _exempt_hosts:
+            return
+        if self.state == HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURES:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    """
+    Returns the percentile given (0 to 100) of the latencies of the host, or None without samples.
+    """
+    def percentile(self, percent):
+        if len(self.latencies) == 0:
+            return None
+        ordered = sorted(self.latencies)
+        position = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+        return ordered[position]
+
+    """
+    Returns the timeout of the next request to the host, in seconds.
+    """
+    def timeout(self):
+        if len(self.latencies) < MIN_SAMPLES:
+            return DEFAULT_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.percentile(95) * TIMEOUT_P95_FACTOR))
+
+    """
+    Returns the seconds to wait before sending a hedged request.
+    """
+    def hedge_delay(self):
+        p95 = self.percentile(95)
+        return max(HEDGE_MIN_DELAY, p95) if p95 is not None and len(self.latencies) >= MIN_SAMPLES else DEFAULT_TIMEOUT / 2
+
+    """
+    Returns the stats as a dictionary.
+    """
+    def snapshot(self):
+        return {
+            "host": self.host,
+            "state": self.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "time_spent": round(self.time_spent, 3),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "timeout": self.timeout(),
+        }
+
+_hosts = {} # { host : HostStats }
+_exempt_hosts = set() # hosts whose circuit never opens
+
+"""
+Returns the host of the url.
+"""
+def get_host(url):
+    return urlparse(str(url)).hostname or str(url)
+
+"""
+Exempts the hosts of the urls given from the circuit breaker. Their stats and timeouts are still kept.
+"""
+def exempt_from_circuit(*urls):
+    for url in urls:
+        _exempt_hosts.add(get_host(url))
+
+"""
+Returns if the exception of a request means that the host is failing: a timeout, a connection error or
+an answer 5xx. Other errors (4xx, content that isn't text...) are problems of the page requested.
+"""
+def is_host_failure(exception):
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code >= 500
+    return isinstance(exception, (asyncio.TimeoutError, httpx.TransportError))
+
+"""
+Returns the HostStats of the host, creating them the first time.
+"""
+def get_stats(host):
+    if host not in _hosts:
+        _hosts[host] = HostStats(host)
+    return _hosts[host]
+
+"""
+Returns the stats of every host, sorted by the time spent waiting for them (the hosts that use most of
+the latency budget first).
+"""
+def get_host_stats():
+    return sorted([stats.snapshot() for stats in list(_hosts.values())],
+                  key=lambda snapshot: snapshot["time_spent"], reverse=True)
+
+"""
+Awaits the request with the timeout given and records its latency and result in stats. Errors that
+aren't failures of the host (see is_host_failure) count as answers of the host.
+"""
+async def timed(stats, make_request, timeout):
+    start = time.monotonic()
+    try:
+        result = await asyncio.wait_for(make_request(), timeout)
+    except Exception as e:
+        if is_host_failure(e):
+            stats.record_failure(time.monotonic() - start)
+        else:
+            stats.record_success(time.monotonic() - start)
+        raise
+    if getattr(result, "status_code", 0) >= 500: # responses of the APIs, that don't raise
+        stats.record_failure(time.monotonic() - start)
+    else:
+        stats.record_success(time.monotonic() - start)
+    return result
+
+"""
+Makes the request and, if it takes longer than usual for the host, a duplicated one. Returns the result
+of the first that succeeds and cancels the other. on_hedge, if given, is called when the duplicated
+request is sent.
+"""
+async def hedged(stats, make_request, timeout, on_hedge=None):
+    first = asyncio.ensure_future(timed(stats, make_request, timeout))
+    done, _ = await asyncio.wait({first}, timeout=stats.hedge_delay())
+    if first in done:
+        return first.result()
+
+    stats.hedged += 1
+    if on_hedge is not None:
+        on_hedge()
+    second = asyncio.ensure_future(timed(stats, make_request, timeout))
+    attempts = {first, second}
+    try:
+        while len(attempts) > 0:
+            done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    return attempt.result()
+        raise done.pop().exception() # both failed
+    finally:
+        for attempt in (first, second):
+            if attempt.done() and not attempt.cancelled():
+                attempt.exception() # retrieved, so asyncio doesn't log it
+            else:
+                attempt.cancel()
+
+"""
+Makes the request to the url given through the circuit breaker of its host, with its adaptive timeout.
+make_request is a function without parameters that returns the coroutine of the request. If hedge is
+True, a duplicated request is sent when the first one is slow and on_hedge, if given, is called then (for
+example, to count the quota it uses). Raises CircuitOpenError if the host keeps failing, without making
+the request.
+"""
+async def request(url, make_request, hedge=False, on_hedge=None):
+    stats = get_stats(get_host(url))
+    if not stats.allow_request():
+        raise CircuitOpenError(stats.host)
+    if hedge:
+        return await hedged(stats, make_request, stats.timeout(), on_hedge)
+    return await timed(stats, make_request, stats.timeout())
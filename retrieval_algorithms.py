@@ -4,29 +4,120 @@ Algorithms to retrieve information by cleaning a query and then, using the terms
 provide to the user relevant information. This information is related to restaurants that may be
 a good fit for the user.
 """
-import requests
+import asyncio
+import httpx
+import logging
 import os
-from threading import Thread
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+from cache import normalize_key, places_cache
+from page_store import page_store
+from site_index import site_index
+from place_index import NEARBY_MIN_PLACES, place_index
+from inverted_index import get_index
+from scoring import SCORING_MODE, get_weights
+from top_k import RANKING_SIZE, TopK, get_result_key
+from matcher import TermMatcher, TokenCounter
+from page_fetcher import fetch_text
+from text_analysis import analyze_query
+from candidate_filter import CandidateFilter
+import resilience
+from quota import BACKGROUND, ENRICHMENT, FIRST_PAGE, NEXT_PAGE, QuotaExceededError, places_scheduler, search_scheduler
+from telemetry import increment, register_collector, span
+from single_flight import SingleFlight
 
 JSON_RESULTS_SEARCH_API = "items"
 
+# API endpoints. Can be changed to use a local stand-in server (see benchmarks/)
+SEARCH_API_URL = os.getenv('SEARCH_API_URL', "https://www.googleapis.com/customsearch/v1")
+PLACE_API_URL = os.getenv('PLACE_API_URL', "https://maps.googleapis.com/maps/api/place/textsearch/json")
+
+# Every search needs the APIs, so their hosts never stop being requested
+resilience.exempt_from_circuit(SEARCH_API_URL, PLACE_API_URL)
+
+# Concurrency constants
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', 8)) # per ranking
+MAX_POOL_CONNECTIONS = int(os.getenv('MAX_POOL_CONNECTIONS', 50)) # shared by every user
+REQUEST_TIMEOUT = 3 # seconds
+
+# Progressive ranking constants
+RANKING_TIME_BUDGET = float(os.getenv('RANKING_TIME_BUDGET', 20)) # seconds, 0 waits for every result
+PROVISIONAL_AFTER = int(os.getenv('PROVISIONAL_AFTER', 5)) # results finished before the first provisional top
+
 # Place API constants
 JSON_RESULTS_PLACE_API = "results"
 JSON_PLACE_NAME_PLACE_API = "name"
 JSON_PLACE_PRICE_STATUS_PLACE_API = "price_level"
 JSON_PLACE_RATING_PLACE_API = "rating"
 JSON_PLACE_WEBSITE_PLACE_API = "website"
+JSON_PLACE_ID_PLACE_API = "place_id"
+JSON_NEXT_PAGE_TOKEN_PLACE_API = "next_page_token"
+MAX_PLACE_PAGES = int(os.getenv('API_CALLS_AMOUNT', 3)) # pages of 20 results, the API gives at most 3
+MIN_RANKED_RESULTS = int(os.getenv('MIN_RANKED_RESULTS', RANKING_SIZE)) # results with weight before paging stops
+PAGE_TOKEN_DELAY = 1 # seconds between the requests of a page whose token isn't valid yet
+PAGE_TOKEN_RETRIES = 3
+PAGE_TOKEN_WARMUP = 10 # seconds after receiving a token while it may still be not valid yet
+PAGE_TOKEN_TTL = 60 * 2 # seconds a page token is used, Google expires them after a few minutes
+JSON_FETCHED_AT = "coco_fetched_at" # added to the cached responses
+
+# Page of the Place API results. next_page is a function that loads the next PlacePage, or None. area is
+# the area of the user if the page was answered from the place index, as its results depend on it
+PlacePage = namedtuple("PlacePage", ["items", "next_page", "area"], defaults=[None])
+
+_client = None
+
+# Identical searches in flight are run once and shared by every user, keyed by the normalized query
+results_flights = SingleFlight("results")
+ranking_flights = SingleFlight("ranking")
+
+"""
+Returns the async HTTP client shared by every conversation. Its connection pool is reused
+between requests so concurrent users don't open new connections for every call.
+"""
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=MAX_POOL_CONNECTIONS,
+                                max_keepalive_connections=MAX_POOL_CONNECTIONS)
+        )
+    return _client
 
 """
-Will make the GET requests with the Google API
+Closes the shared HTTP client. Should be called when the bot shuts down.
+"""
+async def close_client(*args):
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 """
-def get_request(url, params):
+Will make the GET requests with the Google API. Slow requests are repeated (hedged) unless hedge is False.
+The repeated requests are charged to the quota of the Place API.
+"""
+async def get_request(url, params, hedge=True):
     try:
-        r = requests.get(url = url, params = params)
+        r = await resilience.request(url, lambda: get_client().get(url, params = params), hedge=hedge,
+                                        on_hedge=get_hedge_counter(places_scheduler))
         return r.json()
     except Exception as e:
+        increment("coco_api_failures_total", api="places", reason=type(e).__name__)
         print(e)
 
+"""
+Returns the function that counts the duplicated request of a hedged call in the quota and the metrics of
+the API of the scheduler.
+"""
+def get_hedge_counter(scheduler):
+    def count_hedge():
+        scheduler.charge()
+        increment("coco_api_calls_total", api=scheduler.name)
+    return count_hedge
+
 """ 
 Will return the Google API Key thats its set in the environment.
 """
@@ -56,203 +147,427 @@ def get_query(query):
 Returns the query with the requested format.
 """
 def get_query_place_api(query):
-    return "query="+query
+    return "query="+query.text
 
 """ 
 Returns the url to make the get request and get the results.
 """
 def get_url_search_api(query, start):
-    return f"https://www.googleapis.com/customsearch/v1?{get_search_key()}&{get_cx()}&{get_query(query)}&num=10&start={start}"
+    return f"{SEARCH_API_URL}?{get_search_key()}&{get_cx()}&{get_query(query)}&num=10&start={start}"
 
 """ 
-Returns the url to make the get request and get the results.
+Returns the url to make the get request and get the results. query is a text_analysis.Query. The pages
+after the first one are requested only with the page_token given in the previous page.
 """
-def get_url_place_api(query, start):
-    return f"https://maps.googleapis.com/maps/api/place/textsearch/json?{get_query_place_api(query)}&{get_key()}"
+def get_url_place_api(query, page_token=None):
+    if page_token is not None:
+        return f"{PLACE_API_URL}?pagetoken={page_token}&{get_key()}"
+    return f"{PLACE_API_URL}?{get_query_place_api(query)}&{get_key()}"
 
 """ 
-Removes the stopwords such as innecesary or repeated words in the query. Will return the phrase
-given without the stopwords in order to create the query afterwards.
-"""
-def remove_stopwords(phrase, stopword):
-    """
-    File obtained from https://github.com/xiamx/node-nltk-stopwords/blob/master/data/stopwords/spanish 
-    and modified so it can adapt to this program.
-    """
-    new_text = []
-    phrase_splitted = phrase.split()
-    for i in range(len(phrase_splitted)):
-        if phrase_splitted[i] != stopword:
-            new_text.append(phrase_splitted[i])
-    return " ".join(new_text)
-        
-""" 
-Cleans the query by removing stopwords and returns the new query with only relevant keywords.
+Cleans the query by removing stopwords and returns the new query (text_analysis.Query) with only
+relevant keywords. Returns False and the error if no keyword is left.
 """
 def clean_query(food, place, extras):
-    try:
-        stopwords_file = open("stopwords.txt", "r")
-        for stopword in stopwords_file:
-            stopword = stopword.replace("\n", "") # sanitize
-            food = remove_stopwords(food, stopword)
-            place = remove_stopwords(place, stopword)
-            extras = remove_stopwords(extras, stopword)
-
-        query = food + " " + extras + " en Costa Rica " + place
-        stopwords_file.close()
+    with span("clean_query"):
+        query = analyze_query(food, place, extras)
+        if len(query.terms) == 0:
+            return False, "The query only has stopwords"
         return True, query
-    except:
-        return False, "Couldn't open the file"
-
-""" 
-Check that the results wont be repeated and that they are considered relevant. Returns if is valid.
-"""
-def hostname_allowed(link):
-    # These sites are removed as they provide tops or information not directly relevant.
-    denied_sites_keywords = ["instagram","moovitapp","five","mochil","ihop","economi","miami",
-            "new","yelp","tips","ucr","deli","wiki","viaje","travel","facebook","twitter","free",
-            "top","expedia","tiktok","find","search","foursquare", "baix", "trip", "pdf", "sale"]
-    for keyword in denied_sites_keywords:
-        if keyword in link:
-            return False
-    return True
 
 """ 
-Will get the results by making the get request to the api. Will do it api_calls_amount of times.
-If no results are received, then will return None as an error. Else, will return the array of data.
-The param user is the reference of the Telegram user.
-"""
-def get_results(query, logger, user):
-    start = 1
-    items = []
-    api_calls_amount = int(os.getenv('API_CALLS_AMOUNT'))
-    for _ in range(api_calls_amount): # Amount of API calls
+Returns the Place API response of the page given (starting from 1) for the query. The pages after the first
+one need the next_page_token of previous, the response of the previous page. Responses are cached by the
+cleaned query and the page, so the API is only called if the same page wasn't requested recently (or if
+fresh is True). Failed responses aren't cached. Every response saves when it was received, as its token
+expires after PAGE_TOKEN_TTL seconds: an expired token is replaced by requesting the previous page again.
+A new page token isn't valid for a couple of seconds, so the request is repeated while the API says so,
+only if the token was just received.
+The calls go through the quota scheduler. If the quota isn't available, answers with the expired response
+of the cache, if any. The places received are saved in the place index.
+"""
+async def get_place_api_response(query, page, previous=None, fresh=False):
+    cache_key = query.text + " " + str(page)
+    data = places_cache.get(cache_key) if not fresh else None
+    if data is not None:
+        return data
+    page_token = None
+    if page > 1:
+        if previous is not None and get_token_age(previous) >= PAGE_TOKEN_TTL:
+            # The previous page was cached with an expired token, it is requested again for a new one
+            older = places_cache.get_stale(query.text + " " + str(page - 2)) if page > 2 else None
+            previous = await get_place_api_response(query, page - 1, older, fresh=True)
+        page_token = previous.get(JSON_NEXT_PAGE_TOKEN_PLACE_API) if previous is not None else None
+        if page_token is None:
+            return None
+    for attempt in range(PAGE_TOKEN_RETRIES + 1):
         try:
-            url = get_url_place_api(query, start)
-            data = get_request(url, None)
-            start += 10 # moves to next page of results
-            items += data[JSON_RESULTS_PLACE_API]
-        except Exception as e:
-            # May happen if there are not many results or qouta exceeded
-            logger.warning("Error %s in get api call for user %s", str(e), user.first_name) 
-    return items if len(items) > 0 else None
+            await places_scheduler.acquire(FIRST_PAGE if page == 1 else NEXT_PAGE)
+        except QuotaExceededError as e:
+            increment("coco_degraded_total", api="places", reason=e.reason)
+            return places_cache.get_stale(cache_key) # only cached data, or nothing for the next pages
+        increment("coco_api_calls_total", api="places")
+        with span("places_call", page=page):
+            data = await get_request(get_url_place_api(query, page_token), None,
+                                        hedge=not places_scheduler.under_pressure())
+        if (page_token is None or data is None or data.get("status") != "INVALID_REQUEST"
+                or attempt == PAGE_TOKEN_RETRIES or get_token_age(previous) > PAGE_TOKEN_WARMUP):
+            break
+        await asyncio.sleep(PAGE_TOKEN_DELAY)
+    if data is not None and len(data.get(JSON_RESULTS_PLACE_API, [])) > 0:
+        data[JSON_FETCHED_AT] = time.time()
+        places_cache.set(cache_key, data)
+        place_index.save_results(data[JSON_RESULTS_PLACE_API], query.terms)
+    return data
+
+"""
+Returns the seconds since the Place API response was received, or infinity if it isn't known.
+"""
+def get_token_age(data):
+    return time.time() - data.get(JSON_FETCHED_AT, float("-inf"))
+
+"""
+Returns a function without parameters that loads the page of results after the one of data (the response of
+the page number given). The function returns the PlacePage of the next page. Returns None if there
+are no more pages or MAX_PLACE_PAGES were already requested.
+"""
+def get_next_page(query, data, page):
+    if data is None or JSON_NEXT_PAGE_TOKEN_PLACE_API not in data or page >= MAX_PLACE_PAGES:
+        return None
+    async def load_next_page():
+        next_data = await get_place_api_response(query, page + 1, data)
+        if next_data is None:
+            return PlacePage([], None)
+        return PlacePage(next_data.get(JSON_RESULTS_PLACE_API, []), get_next_page(query, next_data, page + 1))
+    return load_next_page
 
 """ 
-Will receive the ranking weights and its an array of 5 tuples (weight, result object).
-Asks if the new weight should be inside the top and if thats the case, will add it to the ranking
-and move to the end all the rest of results. The last result will disappear as it will no longer 
-be top 5.
-"""
-def update_top(ranking_weights, new_weight, new_result):
-    tmp_weight = 0
-    tmp_result = None
-    changed = False
-    for i,tuple in enumerate(ranking_weights):
-        weight_in_top = tuple[0]
-        result_in_top = tuple[1]
-        # Move the values if it was updated
-        if changed:
-            ranking_weights[i] = (tmp_weight, tmp_result)
-            tmp_weight = weight_in_top
-            tmp_result = result_in_top
-
-        # Check if needs to update
-        elif weight_in_top <= new_weight:
-            tmp_weight = weight_in_top
-            tmp_result = result_in_top
-            ranking_weights[i] = (new_weight, new_result)
-            changed = True # Top updated. Following values will reaccommodate.
+Will get the first page of results by making the get request to the api. If no results are received,
+then will return None as an error. Else, will return a PlacePage with the results and the function that
+loads the next page, which get_relevant_results calls only if it needs more results.
+The param user is the reference of the Telegram user. Concurrent calls with the same query share the
+same requests and receive the same page, which must not be modified.
+If user_location, a tuple (latitude, longitude), is given and the query doesn't have a place (the user
+asked for restaurants near them), the page is made of the places of the place index near the user, when
+at least NEARBY_MIN_PLACES are known. Then the Place API is only called as the next page, if the ranking
+needs more results.
+"""
+async def get_results(query, logger, user, user_location=None):
+    if user_location is not None and query.location == "":
+        with span("place_lookup"):
+            items = place_index.nearby(query.terms, user_location)
+        if len(items) >= NEARBY_MIN_PLACES:
+            increment("coco_local_answers_total")
+            logger.info("Query %s answered with %d places near user %s", query.text, len(items), user.first_name)
+            async def load_api_page():
+                page = await get_results(query, logger, user)
+                return page if page is not None else PlacePage([], None)
+            return PlacePage(items, load_api_page, place_index.get_area(user_location))
+    return await results_flights.run(normalize_key(query.text), lambda _: get_place_results(query, logger, user))
 
 """ 
-Initialize a top 5 with empty tuples (weight, result object) and the complete ranking {}.
-Will iterate per every result received and make a GET request to the specific link related to it.
-
-Then, will calculate the terms weight algorithm with the body response of the request and save the results
-in a dictionary per result. So, every result has a dictionary (named words) that goes {keyword: weight}. 
-Every result will be saved in the ranking dictionary with the URL as key and the value is a tuple of the total
-weight and the word dictionary mentioned earlier.
-
-At the end of the process of every result, the program will check if the result should be in the top 5 relevant
-results and if thats the case will add it to top_more_weights. Thats a list of tuples (weight, result object) where
-the first value is the top 1 relevant result.
-"""
-def get_ranking(top_more_weights, results, query):
-    pages_already_seen = [] # avoids repetition
-    ranking = {} # { result url : ( total_weight, { word: weight }) }
-    for result in results:
-        words = {}
-        weight_sum = 0
-        try:
+Makes the Place API call of get_results.
+"""
+async def get_place_results(query, logger, user):
+    try:
+        data = await get_place_api_response(query, 1)
+        items = data[JSON_RESULTS_PLACE_API]
+    except Exception as e:
+        # May happen if there are not results or qouta exceeded
+        logger.warning("Error %s in get api call for user %s", str(e), user.first_name)
+        return None
+    logger.info("Place API cache stats: %s", places_cache.stats())
+    return PlacePage(items, get_next_page(query, data, 1)) if len(items) > 0 else None
+
+"""
+Returns the PageEntry of the page, with its term frequency {term: count}. If the page store has a
+fresh copy, the page isn't fetched. If it has an old one, makes a conditional GET and reuses it when the
+site answers 304 Not Modified. Otherwise, downloads the page and saves its terms in the store.
+"""
+async def get_page_terms(client, url):
+    entry = page_store.get(url)
+    if entry is not None and page_store.is_fresh(entry):
+        page_store.fresh_hits += 1
+        return entry
+
+    counter = TokenCounter() # counts the visible text while it downloads
+    headers = page_store.conditional_headers(entry)
+    with span("page_fetch"):
+        response = await resilience.request(url, lambda: fetch_text(client, url, counter, headers=headers))
+    if response.status_code == 304 and entry is not None:
+        page_store.revalidations += 1
+        return page_store.touch(entry)
+
+    page_store.downloads += 1
+    terms = counter.close()
+    return page_store.save(url, terms, response.headers.get("etag"), response.headers.get("last-modified"))
+
+"""
+Downloads the page and counts the words of the query with the matcher while it downloads. Used when the
+page store is disabled. Returns a tuple of the term frequency {word: count} and the length of the page.
+"""
+async def match_page_terms(client, url, matcher):
+    stream = matcher.stream(count_length=SCORING_MODE == "bm25") # the length is only used by bm25
+    with span("page_fetch"):
+        await resilience.request(url, lambda: fetch_text(client, url, stream))
+    return stream.close(), stream.length
+
+"""
+Returns the website of the restaurant or None if it doesn't have one. Uses the site index first, then
+the website included in the Place API result and only if both are missing, the Custom Search API, with
+the priority given in the quota scheduler. If its quota isn't available, the search is skipped and the
+expired website of the site index is used, if any.
+Restaurants without results in the search are saved as well, so they aren't searched again soon.
+"""
+async def get_website(client, result, priority=ENRICHMENT):
+    place_id = result.get(JSON_PLACE_ID_PLACE_API)
+    name = result[JSON_PLACE_NAME_PLACE_API]
+    entry = site_index.get(place_id) if place_id else None
+    if entry is not None:
+        return entry.url
 
-            if (result[JSON_PLACE_NAME_PLACE_API] in pages_already_seen):
-                continue # ignore as it is repeated or not relevant result
-            query_per_restaurant = get_url_search_api(result[JSON_PLACE_NAME_PLACE_API]+"en Costa Rica",10)
-            #print("Primer llamado con consulta: ", query_per_restaurant)
-            response = requests.get(query_per_restaurant,
-                                                     timeout=3).json() # GET request of 
-            #print("Segundo print a", response["items"][0]["link"])
-            data_of_first_page = requests.get(response["items"][0]["link"],
-                                                     timeout=3) # GET request
-            data = str(data_of_first_page.text).lower() # body response
-
-            for word in query.split(" "):
-                if word == "" or word == "in" or word == " ": continue # ignore stopwords
-                counter = data.count(word.lower()) # calculate weight of every word in the body
-                if counter > 0:
-                    words[word] = counter
-                weight_sum += counter # updating total weight
-            pages_already_seen.append(result[JSON_PLACE_NAME_PLACE_API]) 
+    website = result.get(JSON_PLACE_WEBSITE_PLACE_API)
+    if website:
+        if place_id: site_index.save(place_id, name, website, "places")
+        return website
 
+    try:
+        await search_scheduler.acquire(priority)
+    except QuotaExceededError as e:
+        increment("coco_degraded_total", api="search", reason=e.reason)
+        return site_index.peek(place_id) if place_id else None
+    query_per_restaurant = get_url_search_api(name+"en Costa Rica",10)
+    increment("coco_api_calls_total", api="search")
+    with span("search_call"):
+        response = (await resilience.request(query_per_restaurant, lambda: client.get(query_per_restaurant),
+                                                hedge=not search_scheduler.under_pressure(),
+                                                on_hedge=get_hedge_counter(search_scheduler))).json() # GET request of the search API
+    if "error" in response:
+        raise Exception(response["error"]) # quota exceeded or invalid request, it is not saved
+    items = response.get(JSON_RESULTS_SEARCH_API, [])
+    website = items[0]["link"] if len(items) > 0 else None
+    if place_id: site_index.save(place_id, name, website, "search")
+    return website
+
+"""
+Resolves again the websites that expired in the site index, at most limit of them. Will be called
+periodically so the ranking rarely needs to call the Custom Search API. Does nothing while the quota of
+the Custom Search API is under pressure for the background calls, as the searches of the users go first.
+The websites taken from the Place API are skipped: they are renewed when a search returns the restaurant
+again, and the Custom Search API would only guess a worse one.
+"""
+async def refresh_site_index(logger, limit=50):
+    if search_scheduler.under_pressure(BACKGROUND):
+        logger.info("Site index not refreshed, the search quota is under pressure: %s", search_scheduler.stats())
+        return
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async def refresh(entry):
+        async with semaphore:
+            try:
+                await get_website(get_client(), {JSON_PLACE_ID_PLACE_API: entry.place_id,
+                                                 JSON_PLACE_NAME_PLACE_API: entry.name}, BACKGROUND)
+            except Exception as e:
+                logger.warning("Error %s refreshing the website of %s", str(e), entry.name)
+    expired = [entry for entry in site_index.expired_entries() if entry.source != "places"][:limit]
+    await asyncio.gather(*[refresh(entry) for entry in expired])
+    logger.info("Site index refreshed %d websites. Stats: %s", len(expired), site_index.stats())
+
+"""
+Makes the GET requests for a single result and returns a tuple of the term frequency of its page
+{word: count}, only with the words given, and the length of the page. If the index mode is enabled and
+the page is indexed, it is read from the index without any request. If the page store is disabled, the
+words are counted with the matcher of the query. Returns None if there was an error with the result or
+the candidate filter skipped its website. The semaphore bounds how many results are fetched at once.
+"""
+async def get_result_terms(result, query_words, matcher, semaphore, candidate_filter, logger):
+    async with semaphore:
+        try:
+            client = get_client()
+            website = await get_website(client, result)
+            if website is None:
+                return None # Without a page there is nothing to weight
+            if not candidate_filter.admit_url(website, get_result_key(result)):
+                return None # not a restaurant website or already fetched for another result
+            index = get_index()
+            if index is not None and website in index:
+                return index.term_frequencies(website, query_words), index.document_length(website)
+            if not page_store.enabled:
+                return await match_page_terms(client, website, matcher)
+            entry = await get_page_terms(client, website) # not indexed yet, fetched live
         except Exception as e:
-            print(e)
-            continue # There was en error with the result. Will ignore it.
+            increment("coco_fetch_failures_total", reason=type(e).__name__)
+            logger.warning("Error %r getting the page of %s", e, result.get(JSON_PLACE_NAME_PLACE_API))
+            return None # There was en error with the result. Will ignore it.
+    return {word: entry.terms[word] for word in query_words if word in entry.terms}, entry.length
+
+"""
+Scores the documents of the candidates in a single pass with the scoring engine and returns a new TopK
+of size and k as top_more_weights. documents is a list of tuples ({word: count}, length).
+Only the results with the weight of some word of the query are ranked.
+"""
+def rank_documents(top_more_weights, candidates, documents, query_words):
+    # The index has better statistics of the words than the candidates alone
+    index = get_index()
+    document_frequencies = [index.document_frequency(word) for word in query_words] if index else None
+    total_documents = len(index) if index else None
+    with span("scoring", documents=len(documents)):
+        weights = get_weights(documents, query_words, document_frequencies=document_frequencies,
+                                total_documents=total_documents)
 
+    top = TopK(top_more_weights.k, top_more_weights.size)
+    for result, (weight_sum, words) in zip(candidates, weights):
         if len(words) > 0: # If there were results
-            ranking[result[JSON_PLACE_NAME_PLACE_API]] = (weight_sum, words, result)
-            # Check if result is in the top 5 of relevant results
-            update_top(top_more_weights, weight_sum, result)
+            # Check if result is in the top of relevant results
+            top.push(weight_sum, result)
+    return top
+
+""" 
+Fetches every result received concurrently, at most MAX_CONCURRENT_REQUESTS at a time, and scores them
+as they finish. The results skipped by the candidate filter (repeated or with a website that isn't a
+restaurant page) are never fetched. The pages are weighted with the terms of the query, a
+text_analysis.Query. The work still pending after RANKING_TIME_BUDGET seconds is cancelled, so a slow
+site can't hold up the answer.
+
+If next_page is given (see get_next_page), the next page of the Place API results is requested as soon as
+the results still being fetched can't reach MIN_RANKED_RESULTS results with weight, and its results are
+fetched as they arrive, while the current ones are still being ranked. Paging stops once enough results
+have weight or there are no more pages.
+
+If on_progress is given, it is awaited with a provisional ranking (TopK) once PROVISIONAL_AFTER results
+were scored, and again every time more results are scored. At the end, the ranking of every result scored
+is added to top_more_weights, a TopK that only keeps the most relevant results.
+"""
+async def get_ranking(top_more_weights, results, query, logger, on_progress=None, next_page=None):
+    candidate_filter = CandidateFilter() # shared by the results of every page
+    query_words = list(query.terms)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    matcher = TermMatcher(query_words, stemmed=True) # compiled once for every page
+    tasks = {} # { task : result object }
+
+    def add_candidates(items):
+        for result in items:
+            if JSON_PLACE_NAME_PLACE_API not in result:
+                continue # can't be searched or shown
+            place_id = result.get(JSON_PLACE_ID_PLACE_API)
+            if candidate_filter.admit(result, site_index.peek(place_id) if place_id else None):
+                task = asyncio.ensure_future(get_result_terms(result, query_words, matcher, semaphore,
+                                                              candidate_filter, logger))
+                tasks[task] = result
+                pending.add(task)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RANKING_TIME_BUDGET if RANKING_TIME_BUDGET > 0 else None
+    scored_candidates = []
+    documents = []
+    with_weight = 0 # documents with some word of the query
+    finished = 0
+    pending = set()
+    page_task = None # request of the next page of results
+    add_candidates(results)
+    try:
+        while True:
+            if page_task is None and next_page is not None and with_weight + len(pending) < MIN_RANKED_RESULTS:
+                page_task = asyncio.ensure_future(next_page()) # the current results may not be enough
+                next_page = None
+                pending.add(page_task)
+            if len(pending) == 0:
+                break
+            timeout = deadline - loop.time() if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is page_task:
+                    page_task = None
+                    if task.exception() is not None:
+                        # keeps ranking the results already received
+                        logger.warning("Error %r getting the next page of results", task.exception())
+                    else:
+                        add_candidates(task.result().items)
+                        next_page = task.result().next_page
+                    continue
+                finished += 1
+                if not task.cancelled() and task.exception() is None and task.result() is not None:
+                    scored_candidates.append(tasks[task])
+                    documents.append(task.result())
+                    with_weight += 1 if len(task.result()[0]) > 0 else 0
+            if on_progress is not None and len(pending) > 0 and len(done) > 0 and finished >= PROVISIONAL_AFTER:
+                await on_progress(rank_documents(top_more_weights, scored_candidates, documents, query_words))
+    finally:
+        for task in pending:
+            task.cancel() # out of time budget
+    if len(pending) > 0:
+        logger.info("%d requests cancelled after the time budget of %s seconds", len(pending), RANKING_TIME_BUDGET)
+        increment("coco_fetch_failures_total", len(pending), reason="time_budget")
+
+    ranking = rank_documents(top_more_weights, scored_candidates, documents, query_words)
+    with span("top_k_merge"):
+        top_more_weights.merge(ranking)
     return top_more_weights
 
 """ 
-Will split list of results to allow parallelism.
+Will check if results were received from the API GET general request (the PlacePage of get_results) and if
+thats the case starts with filtering hostnames and calculating the weights, requesting the next pages if
+needed. Returns the ranking as a TopK, whose ranked() method gives the list of tuples (weight, result object),
+or None if an error occurred. on_progress receives the provisional rankings, as explained in get_ranking.
+Concurrent calls with the same query (and the same area, if the page was answered from the place index)
+share a single ranking, whose provisional versions are sent to the on_progress of every caller. The ranking
+returned is shared as well, so it must not be modified.
 """
-def split_list(a_list):
-    half = len(a_list)//2
-    return a_list[:half], a_list[half:]
+async def get_relevant_results(page, query, logger, user, on_progress=None):
+    key = normalize_key(query.text) + (" @" + page.area if page.area is not None else "")
+    return await ranking_flights.run(key,
+                                        lambda broadcast: rank_results(page, query, logger, user, broadcast),
+                                        on_progress)
 
 """ 
-Will check if results were received from the API GET general request and if thats the case
-starts with filtering hostnames and calculating the weights. Returns the ranking as a list og
-tuples (weight, result object) or None if an error occurred.
+Calculates the ranking of get_relevant_results.
 """
-def get_relevant_results(items, query, logger, user):
-    if len(items) > 0:
+async def rank_results(page, query, logger, user, on_progress):
+    if len(page.items) > 0:
         try:
             logger.info("Starting to get ranking for user %s", user.first_name)
-            items1, items2 = split_list(items)
-            ranking1 = [(0, None), 
-                    (0, None), 
-                    (0, None),
-                    (0, None),
-                    (0, None) ] # as will be top 5. (Weight Count, Result)
-            ranking2 = ranking1[:] # Copy
-            #return get_ranking(ranking1, items, query)
-            # Init threads
-            t1 = Thread(target=get_ranking, args=(ranking1, items1, query,))
-            t2 = Thread(target=get_ranking, args=(ranking2, items2, query,))
-            t1.start()
-            t2.start()
-            t1.join()
-            t2.join()
-            # Compare both new rankings
-            for i in range(len(ranking2)): 
-                # This way, ranking2 will be the total ranking
-                update_top(ranking2, ranking1[i][0], ranking1[i][1])
-            return ranking2
+            return await get_ranking(TopK(), page.items, query, logger, on_progress, page.next_page)
         except Exception as e:
             logger.error("Error %s in get relevant results async for user %s", str(e), user.first_name)
     return None # No results or invalid
 
+"""
+Returns the gauges of the caches and of the hosts for the metrics endpoint, as a list of tuples
+(name, labels, value).
+"""
+def get_pipeline_metrics():
+    metrics = []
+    places_stats = places_cache.stats()
+    for tier in ("memory_hits", "disk_hits", "misses"):
+        metrics.append(("coco_cache_lookups", {"cache": "places", "result": tier}, places_stats[tier]))
+    page_stats = page_store.stats()
+    for result in ("fresh_hits", "revalidations", "downloads"):
+        metrics.append(("coco_cache_lookups", {"cache": "pages", "result": result}, page_stats[result]))
+    site_stats = site_index.stats()
+    for result in ("hits", "misses"):
+        metrics.append(("coco_cache_lookups", {"cache": "sites", "result": result}, site_stats[result]))
+    metrics.append(("coco_place_index_entries", {}, len(place_index)))
+    for scheduler in (places_scheduler, search_scheduler):
+        quota_stats = scheduler.stats()
+        api = {"api": quota_stats["api"]}
+        metrics.append(("coco_quota_remaining", api, quota_stats["remaining"]))
+        metrics.append(("coco_quota_waiting", api, quota_stats["waiting"]))
+        metrics.append(("coco_quota_refused", api, quota_stats["refused"]))
+    for host_stats in resilience.get_host_stats():
+        host = {"host": host_stats["host"]}
+        metrics.append(("coco_host_open", host, 1 if host_stats["state"] == resilience.OPEN else 0))
+        metrics.append(("coco_host_requests", dict(host, result="success"), host_stats["successes"]))
+        metrics.append(("coco_host_requests", dict(host, result="failure"), host_stats["failures"]))
+        metrics.append(("coco_host_requests", dict(host, result="rejected"), host_stats["rejected"]))
+        metrics.append(("coco_host_requests", dict(host, result="hedged"), host_stats["hedged"]))
+        metrics.append(("coco_host_seconds", host, host_stats["time_spent"]))
+        metrics.append(("coco_host_p95_seconds", host, host_stats["p95"]))
+        metrics.append(("coco_host_timeout_seconds", host, host_stats["timeout"]))
+    return metrics
+
+register_collector(get_pipeline_metrics)
+
 # Only created for testing purposes before telegram connection
 def main():
     food = input("¿Qué te gustaria comer? ")
@@ -262,10 +577,21 @@ def main():
     status, query_or_error = clean_query(food.lower(), place.lower(), extras.lower())
     #print(query_or_error)
     if status:
-        items = get_results(query_or_error)
-        relevant_results = get_relevant_results(items, query_or_error)
+        asyncio.run(run_query(query_or_error))
     else:
         print(query_or_error)
 
+# Only created for testing purposes before telegram connection
+async def run_query(query):
+    logger = logging.getLogger(__name__)
+    user = SimpleNamespace(first_name="console")
+    try:
+        page = await get_results(query, logger, user)
+        if page is not None:
+            ranking = await get_relevant_results(page, query, logger, user)
+            print(ranking.ranked() if ranking is not None else None)
+    finally:
+        await close_client()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
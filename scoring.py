@@ -0,0 +1,70 @@
+"""
+Scoring engine of the ranking. Receives the term frequency of every candidate page and scores all of
+them at once with NumPy. The weighting can be chosen with SCORING_MODE:
+    tf      the term frequency, as the original Weight Terms algorithm
+    tfidf   the term frequency multiplied by the inverse document frequency of the term
+    bm25    Okapi BM25, which saturates the term frequency and normalizes it by the page length
+The document frequencies are calculated with the candidates, unless other statistics are given (for
+example, the ones of the inverted index).
+"""
+import os
+import numpy as np
+
+SCORING_MODES = ("tf", "tfidf", "bm25")
+SCORING_MODE = os.getenv('SCORING_MODE', 'tf')
+BM25_K1 = float(os.getenv('BM25_K1', 1.2))
+BM25_B = float(os.getenv('BM25_B', 0.75))
+
+"""
+Returns the matrix of term frequencies (candidates x words) and the array of page lengths.
+documents is a list of tuples ({term: count}, length).
+"""
+def get_term_matrix(documents, words):
+    frequencies = np.array([[terms.get(word, 0) for word in words] for terms, _ in documents],
+                           dtype=np.float64).reshape(len(documents), len(words))
+    lengths = np.array([length for _, length in documents], dtype=np.float64)
+    return frequencies, lengths
+
+"""
+Returns the contribution of every word to the score of every candidate, as a matrix (candidates x words).
+The total score of a candidate is the sum of its row. document_frequencies and total_documents may be
+given to use statistics of a bigger collection than the candidates.
+"""
+def score_documents(documents, words, mode=SCORING_MODE, document_frequencies=None, total_documents=None):
+    if mode not in SCORING_MODES:
+        raise ValueError("Unknown scoring mode " + str(mode))
+    frequencies, lengths = get_term_matrix(documents, words)
+    if mode == "tf" or len(documents) == 0:
+        return frequencies
+
+    if document_frequencies is None:
+        document_frequencies = np.count_nonzero(frequencies, axis=0)
+        total_documents = len(documents)
+    df = np.asarray(document_frequencies, dtype=np.float64)
+    n = float(total_documents)
+
+    if mode == "tfidf":
+        idf = np.log((n + 1) / (df + 1)) + 1 # smoothed so terms in every page still count
+        return frequencies * idf
+
+    idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+    average_length = lengths.mean() if lengths.mean() > 0 else 1.0
+    normalization = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+    return idf * frequencies * (BM25_K1 + 1) / (frequencies + normalization[:, np.newaxis])
+
+"""
+Scores the documents and returns, for every candidate, a tuple of the total weight and the word
+dictionary {word: weight} with the words that contributed to it.
+"""
+def get_weights(documents, words, mode=SCORING_MODE, document_frequencies=None, total_documents=None):
+    contributions = score_documents(documents, words, mode, document_frequencies, total_documents)
+    totals = contributions.sum(axis=1)
+    as_number = int if mode == "tf" else float
+    weights = []
+    for row, total in zip(contributions, totals):
+        words_weight = {}
+        for word, contribution in zip(words, row):
+            if contribution > 0:
+                words_weight[word] = as_number(contribution)
+        weights.append((as_number(total), words_weight))
+    return weights
@@ -0,0 +1,167 @@
+"""
+Store of the conversations of the users. Keeps only the fields read by the handlers, evicts the sessions
+idle for longer than SESSION_IDLE_TTL and at most SESSION_MAX_ENTRIES are kept in memory. If the disk
+tier is enabled, every change is saved in SQLite, so the conversations in progress and the results of
+the last search survive a restart of the bot and the sessions evicted from memory can be loaded again.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from cache import CACHE_DB_PATH, get_connection
+
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', CACHE_DB_PATH) # empty keeps the sessions in memory only
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', 60 * 60 * 6)) # seconds without messages
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 10000)) # sessions in memory
+
+# Fields of a Place API result read to show it
+RESULT_FIELDS = ("place_id", "name", "rating", "price_level")
+
+"""
+Returns a copy of the result with only the fields used to show it.
+"""
+def compact_result(result):
+    compact = {field: result[field] for field in RESULT_FIELDS if field in result}
+    if "open_now" in result.get("opening_hours", {}):
+        compact["opening_hours"] = {"open_now": result["opening_hours"]["open_now"]}
+    if "location" in result.get("geometry", {}):
+        location = result["geometry"]["location"]
+        compact["geometry"] = {"location": {"lat": location["lat"], "lng": location["lng"]}}
+    return compact
+
+"""
+Conversation of a user: its answers, the conversation state and the ranking of its last search.
+"""
+class Session:
+    __slots__ = ("user_id", "state", "food", "location", "extra", "latitude", "longitude",
+                 "ranking", "page", "touched_at")
+
+    def __init__(self, user_id, state=None, food="", location="", extra="", latitude=None, longitude=None,
+                 ranking=None, page=0, touched_at=None):
+        self.user_id = user_id
+        self.state = state # state of the ConversationHandler, None when it ended
+        self.food = food
+        self.location = location
+        self.extra = extra
+        self.latitude = latitude # location shared by the user, None if it wasn't shared
+        self.longitude = longitude
+        self.ranking = ranking # list of tuples (weight, compact result object) of the last search
+        self.page = page # page of the ranking shown
+        self.touched_at = touched_at if touched_at is not None else time.time()
+
+    """
+    Returns the location shared by the user as a tuple (latitude, longitude), or None.
+    """
+    @property
+    def user_location(self):
+        return (self.latitude, self.longitude) if self.latitude is not None else None
+
+    """
+    Saves the ranking given, a list of tuples (weight, result object), with only the fields used to show it.
+    """
+    def set_ranking(self, ranking):
+        self.ranking = [(weight, compact_result(result)) for weight, result in ranking]
+        self.page = 0
+
+    def to_json(self):
+        return json.dumps([getattr(self, field) for field in Session.__slots__])
+
+    @staticmethod
+    def from_json(value):
+        session = Session(*json.loads(value))
+        if session.ranking is not None:
+            session.ranking = [tuple(entry) for entry in session.ranking]
+        return session
+
+"""
+Sessions keyed by the Telegram user id, with an LRU memory tier and an optional SQLite disk tier.
+"""
+class SessionStore:
+    def __init__(self, path=SESSION_DB_PATH, idle_ttl=SESSION_IDLE_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict() # { user id : Session }
+        self.evictions = 0
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, value TEXT, touched_at REAL)"
+            )
+
+    """
+    Returns the amount of sessions in memory.
+    """
+    def __len__(self):
+        return len(self.memory)
+
+    """
+    Returns the session of the user or None if it doesn't have one or it was idle for too long.
+    """
+    def get(self, user_id):
+        now = time.time()
+        session = self.memory.get(user_id)
+        if session is None and self.connection is not None:
+            row = self.connection.execute("SELECT value FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                session = Session.from_json(row[0])
+        if session is None:
+            return None
+        if now - session.touched_at >= self.idle_ttl:
+            self.delete(user_id)
+            return None
+        self._remember(session)
+        return session
+
+    """
+    Starts a new session for the user, replacing the previous one.
+    """
+    def create(self, user_id):
+        session = Session(user_id)
+        self.save(session)
+        return session
+
+    """
+    Saves the changes of the session. Must be called after every change so the disk tier is up to date.
+    """
+    def save(self, session):
+        session.touched_at = time.time()
+        self._remember(session)
+        if self.connection is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, value, touched_at) VALUES (?, ?, ?)",
+                (session.user_id, session.to_json(), session.touched_at)
+            )
+
+    def delete(self, user_id):
+        self.memory.pop(user_id, None)
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    """
+    Removes the idle sessions from both tiers. Returns the amount removed from memory.
+    """
+    def purge(self):
+        limit = time.time() - self.idle_ttl
+        idle = [user_id for user_id, session in self.memory.items() if session.touched_at < limit]
+        for user_id in idle:
+            del self.memory[user_id]
+        self.evictions += len(idle)
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM sessions WHERE touched_at < ?", (limit,))
+        return len(idle)
+
+    def stats(self):
+        return {"entries": len(self.memory), "evictions": self.evictions}
+
+    """
+    Keeps the session in memory as the most recently used and evicts the least recently used if it is full.
+    Evicted sessions are still in the disk tier.
+    """
+    def _remember(self, session):
+        self.memory[session.user_id] = session
+        self.memory.move_to_end(session.user_id)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+sessions = SessionStore()
@@ -0,0 +1,77 @@
+"""
+Coalescing of identical work in flight. When many users search the same thing at the same time, the
+first caller runs the work and the others await the same run instead of repeating it, so the calls to
+the APIs and the CPU used grow with the different searches and not with the amount of users. The
+progress of the run (provisional rankings) is sent to the listeners of every caller.
+"""
+import asyncio
+from telemetry import increment
+
+"""
+Work in flight: its task, the listeners of its progress and the last progress sent.
+"""
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.listeners = []
+        self.last_progress = None
+
+    """
+    Sends the progress to every listener at once. An error of a listener doesn't affect the others.
+    """
+    async def broadcast(self, progress):
+        self.last_progress = progress
+        results = await asyncio.gather(*[listener(progress) for listener in list(self.listeners)],
+                                        return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(result)
+
+"""
+Runs the work of every key once at a time. Usage:
+    ranking = await flights.run(key, lambda broadcast: get_ranking(..., on_progress=broadcast), on_progress)
+"""
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.flights = {} # { key : Flight }
+
+    """
+    Returns the result of make_coroutine for the key. If the same key is already running, awaits that run
+    instead of starting another one. make_coroutine receives the function to send the progress and returns
+    the coroutine of the work. on_progress, if given, is awaited with the progress of the run.
+    The run continues even if the caller that started it is cancelled, as others may be waiting for it.
+    """
+    async def run(self, key, make_coroutine, on_progress=None):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.ensure_future(make_coroutine(flight.broadcast))
+            flight.task.add_done_callback(lambda _: self.land(key, flight))
+            increment("coco_flights_total", flight=self.name, result="started")
+        else:
+            increment("coco_flights_total", flight=self.name, result="joined")
+            if on_progress is not None and flight.last_progress is not None:
+                try:
+                    await on_progress(flight.last_progress) # catches up with the ones already waiting
+                except Exception as e:
+                    print(e)
+
+        if on_progress is not None:
+            flight.listeners.append(on_progress)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            if on_progress in flight.listeners:
+                flight.listeners.remove(on_progress)
+
+    """
+    Removes the flight once it finished, so the next call with its key starts a new run.
+    """
+    def land(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def __len__(self):
+        return len(self.flights)
@@ -0,0 +1,129 @@
+"""
+Index of the website of every restaurant, keyed by the place_id of the Place API. Websites are taken
+from the Place API results when they include them and only searched with the Custom Search API when the
+restaurant is unknown. Restaurants without a website are also saved (negative cache) for a shorter time,
+and every website is resolved again after a while so the index doesn't get old.
+"""
+import os
+import time
+from collections import namedtuple
+from cache import CACHE_DB_PATH, get_connection
+
+SITE_INDEX_REFRESH = int(os.getenv('SITE_INDEX_REFRESH', 60 * 60 * 24 * 30)) # seconds a website is valid
+SITE_INDEX_NEGATIVE_TTL = int(os.getenv('SITE_INDEX_NEGATIVE_TTL', 60 * 60 * 24)) # seconds without website
+
+# url is None when the restaurant doesn't have a known website. source is "places" or "search"
+SiteEntry = namedtuple("SiteEntry", ["place_id", "name", "url", "source", "resolved_at"])
+
+"""
+Index {place_id: website} saved in SQLite and kept in memory. SQLite is read again when the memory
+doesn't have a valid entry, so the websites resolved by other processes are found too.
+"""
+class SiteIndex:
+    def __init__(self, path=CACHE_DB_PATH, refresh=SITE_INDEX_REFRESH, negative_ttl=SITE_INDEX_NEGATIVE_TTL):
+        self.refresh = refresh
+        self.negative_ttl = negative_ttl
+        self.entries = {} # { place_id : SiteEntry }
+        self.hits = 0
+        self.misses = 0
+        self.connection = get_connection(path)
+        if self.connection is not None:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sites (place_id TEXT PRIMARY KEY, name TEXT, url TEXT, "
+                "source TEXT, resolved_at REAL)"
+            )
+            self.reload()
+
+    """
+    Reads every entry from SQLite again, with the ones saved by other processes since it was loaded.
+    """
+    def reload(self):
+        if self.connection is None:
+            return
+        self.entries = {row[0]: SiteEntry(*row) for row in
+                        self.connection.execute("SELECT place_id, name, url, source, resolved_at FROM sites")}
+
+    """
+    Returns the SiteEntry of the place if it is known and still valid. Otherwise returns None and the
+    website must be resolved again.
+    """
+    def get(self, place_id):
+        entry = self.entries.get(place_id)
+        if entry is None or self.is_expired(entry):
+            entry = self._load(place_id)
+        if entry is None or self.is_expired(entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    """
+    Returns the website saved for the place even if it expired, or None. It isn't counted in the stats.
+    """
+    def peek(self, place_id):
+        entry = self.entries.get(place_id) or self._load(place_id)
+        return entry.url if entry is not None else None
+
+    """
+    Returns if the entry must be resolved again. Negative entries expire sooner.
+    """
+    def is_expired(self, entry):
+        ttl = self.refresh if entry.url is not None else self.negative_ttl
+        return time.time() - entry.resolved_at >= ttl
+
+    """
+    Saves the website of the place. url may be None to remember that the place doesn't have one.
+    """
+    def save(self, place_id, name, url, source):
+        entry = SiteEntry(place_id, name, url, source, time.time())
+        self.entries[place_id] = entry
+        if self.connection is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sites (place_id, name, url, source, resolved_at) VALUES (?, ?, ?, ?, ?)",
+                entry
+            )
+        return entry
+
+    """
+    Returns the entries that must be resolved again, so a background job can refresh them. They are
+    read from SQLite when there is one, to include the entries saved by other processes.
+    """
+    def expired_entries(self):
+        if self.connection is not None:
+            now = time.time()
+            rows = self.connection.execute(
+                "SELECT place_id, name, url, source, resolved_at FROM sites WHERE "
+                "(url IS NOT NULL AND resolved_at <= ?) OR (url IS NULL AND resolved_at <= ?)",
+                (now - self.refresh, now - self.negative_ttl)
+            ).fetchall()
+            return [SiteEntry(*row) for row in rows]
+        return [entry for entry in self.entries.values() if self.is_expired(entry)]
+
+    """
+    Returns every known website.
+    """
+    def websites(self):
+        return [entry.url for entry in self.entries.values() if entry.url is not None]
+
+    """
+    Returns the counters of the index as a dictionary.
+    """
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    """
+    Reads the entry of the place from SQLite and keeps it in memory. Returns None if it isn't saved.
+    """
+    def _load(self, place_id):
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            "SELECT place_id, name, url, source, resolved_at FROM sites WHERE place_id = ?", (place_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = SiteEntry(*row)
+        self.entries[place_id] = entry
+        return entry
+
+site_index = SiteIndex()
@@ -0,0 +1,221 @@
+"""
+Tracing and metrics of the bot. Every stage of a conversation is timed with span(), which adds its
+duration to a histogram and, if the conversation is sampled, to its trace. Counters keep the API quota
+used, the cache hits and the fetch failures. Everything is exposed in the Prometheus text format by
+start_metrics_server() and the sampled traces are dumped as JSON lines to TRACE_DUMP_PATH.
+
+Usage:
+    trace = start_trace("conversation", user=user.id)
+    with span("clean_query"):
+        ...
+    increment("coco_api_calls_total", api="places")
+    finish_trace(trace)
+"""
+import contextvars
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # 0 disables the endpoint
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0)) # conversations traced, from 0 to 1
+TRACE_DUMP_PATH = os.getenv('TRACE_DUMP_PATH', 'traces.jsonl')
+
+STAGE_HISTOGRAM = "coco_stage_seconds"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+    STAGE_HISTOGRAM: "Duration of every stage of the pipeline",
+    "coco_api_calls_total": "Calls made to the Google APIs (quota used)",
+    "coco_api_failures_total": "Failed calls to the Place API, by reason",
+    "coco_fetch_failures_total": "Results without terms after a failed request, by reason",
+    "coco_searches_total": "Searches answered, by whether they found results",
+    "coco_candidates_skipped_total": "Results of a ranking skipped before fetching their page, by reason",
+    "coco_flights_total": "Runs of the pipeline started and joined by identical searches in flight",
+    "coco_local_answers_total": "Searches near the user answered with the place index, without the Place API",
+    "coco_place_index_entries": "Places saved in the place index",
+    "coco_degraded_total": "Calls to the Google APIs replaced by cached data or skipped, by reason",
+    "coco_quota_remaining": "Calls left today to the API, without a value if unlimited",
+    "coco_quota_waiting": "Calls waiting for a token of the API rate limit",
+    "coco_quota_refused": "Calls refused as the quota wasn't available",
+    "coco_webhook_updates_total": "Updates received by the webhook, by worker and whether they were queued",
+    "coco_webhook_queued": "Updates waiting in the queue of every webhook worker",
+    "coco_cache_lookups": "Lookups of the caches, by result",
+    "coco_host_open": "1 if the circuit of the host is open",
+    "coco_host_requests": "Requests made to the host, by result",
+    "coco_host_seconds": "Seconds spent waiting for the host",
+    "coco_host_p95_seconds": "p95 latency of the host",
+    "coco_host_timeout_seconds": "Current adaptive timeout of the host",
+}
+
+_lock = Lock()
+_counters = {} # { (name, labels) : value }
+_histograms = {} # { (name, labels) : [bucket counts, sum, count] }
+_collectors = [] # functions that return a list of (name, labels dict, value) when the metrics are read
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+"""
+Returns the labels as a sorted tuple, so they can be used as part of a key.
+"""
+def get_labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+"""
+Adds value to the counter with the name and labels given.
+"""
+def increment(name, value=1, **labels):
+    key = (name, get_labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+"""
+Adds the value to the histogram with the name and labels given.
+"""
+def observe(name, value, **labels):
+    key = (name, get_labels_key(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+"""
+Registers a function called every time the metrics are read. It must return a list of tuples
+(name, labels dict, value) with the current values of some gauges (for example, the stats of a cache).
+"""
+def register_collector(collector):
+    _collectors.append(collector)
+
+"""
+Trace of a sampled conversation: the spans of its stages, relative to its start.
+"""
+class Trace:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.timestamp = time.time()
+        self.spans = [] # list of dicts {name, start, duration, labels}
+
+    def to_dict(self):
+        return {"name": self.name, "timestamp": self.timestamp, "labels": self.labels,
+                "duration": time.perf_counter() - self.start, "spans": self.spans}
+
+"""
+Starts the trace of a conversation if it is sampled (TRACE_SAMPLE_RATE). The spans of the current task
+and of the tasks it creates are added to it. Returns the trace or None if it is not sampled.
+"""
+def start_trace(name, **labels):
+    trace = Trace(name, {key: str(value) for key, value in labels.items()}) if random.random() < TRACE_SAMPLE_RATE else None
+    _current_trace.set(trace)
+    return trace
+
+"""
+Finishes the trace and appends it to TRACE_DUMP_PATH.
+"""
+def finish_trace(trace):
+    _current_trace.set(None)
+    if trace is None:
+        return
+    try:
+        with _lock, open(TRACE_DUMP_PATH, "a", encoding="utf-8") as dump:
+            dump.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(e)
+
+"""
+Times the code inside the with block as the stage given. Works in synchronous and asynchronous code
+(in the latter, the time includes the awaits).
+"""
+@contextmanager
+def span(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        observe(STAGE_HISTOGRAM, duration, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append({"name": stage, "start": start - trace.start, "duration": duration,
+                                "labels": {key: str(value) for key, value in labels.items()}})
+
+"""
+Returns the labels in the Prometheus format: {key="value",...}
+"""
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = [key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for key, value in labels]
+    return "{" + ",".join(escaped) + "}"
+
+"""
+Returns every metric in the Prometheus text format.
+"""
+def render_metrics():
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(value[0]), value[1], value[2]) for key, value in _histograms.items()}
+
+    described = set()
+    def describe(name, metric_type):
+        if name not in described:
+            described.add(name)
+            if name in HELP:
+                lines.append("# HELP " + name + " " + HELP[name])
+            lines.append("# TYPE " + name + " " + metric_type)
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, "counter")
+        lines.append(name + format_labels(labels) + " " + str(value))
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        describe(name, "histogram")
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            lines.append(name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " " + str(bucket_count))
+        lines.append(name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " " + str(count))
+        lines.append(name + "_sum" + format_labels(labels) + " " + str(total))
+        lines.append(name + "_count" + format_labels(labels) + " " + str(count))
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                describe(name, "gauge")
+                if value is not None:
+                    lines.append(name + format_labels(get_labels_key(labels)) + " " + str(value))
+        except Exception as e:
+            print(e)
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # quiet
+
+"""
+Starts the HTTP endpoint /metrics in a background thread, if METRICS_PORT is not 0. Returns the server
+or None.
+"""
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    if port == 0:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
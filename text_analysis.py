@@ -0,0 +1,141 @@
+"""
+Text processing shared by the query cleaning and the scoring of the pages. Every text is analyzed the
+same way so the terms of the query can be compared with the terms saved for a page: split in lower case
+tokens, without stopwords, without accents and reduced to their stem ("hamburguesas" -> "hamburgues").
+
+The stopwords are loaded once when the module is imported, which fails if the file is missing.
+"""
+import os
+import re
+import unicodedata
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS_PATH = os.getenv('STOPWORDS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwords.txt"))
+TERM_CACHE_SIZE = int(os.getenv('TERM_CACHE_SIZE', 65536)) # tokens whose term is remembered
+
+# Changes every time the terms produced change, so the terms saved with an older version aren't used
+ANALYZER_VERSION = 2
+
+"""
+Query of a search. text is sent to the APIs, terms are the normalized terms used to score the pages
+and location is the place requested by the user.
+"""
+Query = namedtuple("Query", ["text", "terms", "location"])
+
+"""
+Splits the text in lower case word tokens. Punctuation and markup symbols are ignored.
+"""
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+"""
+Returns the term frequency of the text as a dictionary {term: count}, without stopwords.
+"""
+def count_terms(text):
+    return normalize_counts(Counter(tokenize(text)))
+
+"""
+Returns the counts {token: count} of lower case tokens as counts {term: count} without stopwords.
+Normalizing the distinct tokens once is cheaper than normalizing every occurrence.
+"""
+def normalize_counts(token_counts):
+    terms = Counter()
+    for token, count in token_counts.items():
+        term = normalize_term(token)
+        if term is not None:
+            terms[term] += count
+    return dict(terms)
+
+"""
+Returns a dictionary {accented character: character without accent} of the latin characters, used by
+fold_accents. The ñ is kept as it changes the meaning of the word.
+"""
+def get_accents_table():
+    table = {}
+    for code in range(0x80, 0x250):
+        char = chr(code)
+        if char in "ñÑ":
+            continue
+        base = "".join(c for c in unicodedata.normalize("NFD", char) if not unicodedata.combining(c))
+        if base != char and len(base) > 0:
+            table[char] = base
+    return table
+
+ACCENTS_TABLE = get_accents_table()
+ACCENTS_PATTERN = re.compile("[" + "".join(ACCENTS_TABLE) + "]")
+
+"""
+Removes the accents of the text, so "panamá" and "panama" are the same term.
+"""
+def fold_accents(text):
+    if text.isascii():
+        return text
+    return ACCENTS_PATTERN.sub(lambda match: ACCENTS_TABLE[match.group()], text)
+
+"""
+Reads the stopwords file, one word per line. Returns a frozenset of the stopwords without accents.
+File obtained from https://github.com/xiamx/node-nltk-stopwords/blob/master/data/stopwords/spanish
+and modified so it can adapt to this program.
+"""
+def load_stopwords(path):
+    with open(path, "r", encoding="utf-8") as stopwords_file:
+        return frozenset(fold_accents(line.strip().lower()) for line in stopwords_file if line.strip() != "")
+
+STOPWORDS = load_stopwords(STOPWORDS_PATH)
+
+"""
+Light stemmer of Spanish. Only removes the plural and the final vowel of the gender, so it rarely joins
+words with different meanings: "tacos", "taco" -> "tac"; "panes", "pan" -> "pan"; "luces", "luz" -> "luc".
+The word must be in lower case and without accents.
+"""
+def stem(word):
+    if len(word) > 3 and word.endswith("s"):
+        word = word[:-1]
+    if word.endswith("z"):
+        word = word[:-1] + "c" # as "luces"
+    elif len(word) > 3 and word[-1] in "aeo":
+        word = word[:-1]
+    return word
+
+"""
+Returns the beginnings that every word with the term given has (after stem() removed its ending).
+"""
+def term_prefixes(term):
+    if term.endswith("c"):
+        return [term, term[:-1] + "z"] # "luc" of "luz"
+    return [term]
+
+"""
+Returns the term of the lower case token: without accents and stemmed. Returns None for stopwords.
+The terms of the tokens already seen are remembered, as the same words repeat in every page.
+"""
+@lru_cache(maxsize=TERM_CACHE_SIZE)
+def normalize_term(token):
+    folded = fold_accents(token)
+    if folded in STOPWORDS:
+        return None
+    return stem(folded)
+
+"""
+Returns the words of the text that are not stopwords, keeping the original words (with accents).
+"""
+def remove_stopwords(text):
+    return [word for word in text.split() if fold_accents(word.lower()) not in STOPWORDS]
+
+"""
+Returns the Query of the answers of the user. The text sent to the APIs keeps the words of the user,
+without the stopwords, and adds the country. The terms are the normalized terms of every answer, without
+repetitions.
+"""
+def analyze_query(food, place, extras):
+    food_words, place_words, extras_words = remove_stopwords(food), remove_stopwords(place), remove_stopwords(extras)
+    text = " ".join(food_words + extras_words + ["en", "Costa", "Rica"] + place_words)
+    terms = []
+    for word in food_words + extras_words + place_words:
+        for token in tokenize(word):
+            term = normalize_term(token)
+            if term is not None and term not in terms:
+                terms.append(term)
+    return Query(text, tuple(terms), " ".join(place_words))
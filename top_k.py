@@ -0,0 +1,109 @@
+"""
+Top k of the most relevant results. Keeps a bounded min-heap, so adding a result costs O(log n) and the
+least relevant result is the one evicted when it is full. Besides the k results shown to the user, keeps
+a longer tail so the next pages of results (/mas) can be shown without calculating the ranking again.
+"""
+import heapq
+import os
+from threading import Lock
+
+TOP_K = int(os.getenv('TOP_K', 5)) # results per page
+RANKING_SIZE = int(os.getenv('RANKING_SIZE', 10)) # results kept, including the following pages
+
+"""
+Returns the key used to avoid repeated results: the place_id or the name if it doesn't have one.
+"""
+def get_result_key(result):
+    return result.get("place_id") or result.get("name")
+
+"""
+Bounded ranking of (weight, result object). Results with the same place_id are only kept once, with its
+highest weight. Ties are broken by arrival: the first result received ranks higher. push() can be called
+from any amount of concurrent workers.
+"""
+class TopK:
+    def __init__(self, k=TOP_K, size=RANKING_SIZE):
+        self.k = k
+        self.size = max(k, size)
+        self.heap = [] # min-heap of (weight, -arrival, key). Entries may be stale after a replacement
+        self.entries = {} # { key : (weight, arrival, result object) }
+        self.arrivals = 0
+        self.lock = Lock()
+
+    """
+    Returns the amount of results in the ranking.
+    """
+    def __len__(self):
+        return len(self.entries)
+
+    """
+    Adds the result with its weight if it is relevant enough to be in the ranking. Returns True if it
+    was added.
+    """
+    def push(self, weight, result):
+        key = get_result_key(result)
+        with self.lock:
+            if key in self.entries:
+                if self.entries[key][0] >= weight:
+                    return False # repeated and not more relevant
+                arrival = self.entries[key][1] # keeps its place in the ties
+            else:
+                if len(self.entries) >= self.size and not self._beats_last(weight):
+                    return False
+                self.arrivals += 1
+                arrival = self.arrivals
+            self.entries[key] = (weight, arrival, result)
+            heapq.heappush(self.heap, (weight, -arrival, key))
+            while len(self.entries) > self.size:
+                self._pop_last()
+            if len(self.heap) > 2 * self.size:
+                self._compact()
+            return True
+
+    """
+    Adds every result of the other ranking.
+    """
+    def merge(self, other):
+        for weight, result in other.ranked():
+            self.push(weight, result)
+
+    """
+    Returns the whole ranking as a list of tuples (weight, result object), the most relevant first.
+    """
+    def ranked(self):
+        with self.lock:
+            ordered = sorted(self.entries.values(), key=lambda entry: (-entry[0], entry[1]))
+        return [(weight, result) for weight, _, result in ordered]
+
+    """
+    Returns if a new result with the weight given would be more relevant than the last of the ranking.
+    """
+    def _beats_last(self, weight):
+        self._drop_stale()
+        return len(self.heap) == 0 or weight > self.heap[0][0]
+
+    """
+    Removes the least relevant result.
+    """
+    def _pop_last(self):
+        self._drop_stale()
+        _, _, key = heapq.heappop(self.heap)
+        del self.entries[key]
+
+    """
+    Removes the entries of the top of the heap that were replaced by a higher weight.
+    """
+    def _drop_stale(self):
+        while len(self.heap) > 0:
+            weight, negative_arrival, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == weight and entry[1] == -negative_arrival:
+                return
+            heapq.heappop(self.heap)
+
+    """
+    Rebuilds the heap without stale entries.
+    """
+    def _compact(self):
+        self.heap = [(weight, -arrival, key) for key, (weight, arrival, _) in self.entries.items()]
+        heapq.heapify(self.heap)
@@ -0,0 +1,225 @@
+"""
+Webhook mode of the bot, to use every core of the server. Telegram sends the updates to an HTTP front end
+that only reads them and passes them to a pool of worker processes, each one with its own Application
+and event loop. The chats are assigned to the workers with consistent hashing, so every update of a
+chat goes to the same worker and its conversation stays in that worker's memory. A slow search only
+delays the chats of its worker.
+
+Every worker opens the caches, the indexes and the sessions in the same SQLite files (CACHE_DB_PATH),
+which are the backend shared by all of them. Their memory only keeps what the worker used, and SQLite
+is read when it misses, so the Google APIs aren't called again for the searches made in another worker.
+If the amount of workers changes, only a part of the chats move to another worker and they continue
+their conversation from the session saved.
+
+Telegram only calls webhooks over HTTPS, so the front end is meant to run behind a reverse proxy with
+the certificate (nginx, Caddy...) that forwards WEBHOOK_URL to WEBHOOK_HOST:WEBHOOK_PORT. Usage:
+
+    py -3 webhook.py
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlparse
+from telemetry import METRICS_PORT, increment, register_collector, start_metrics_server
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '') # public https url registered in Telegram
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '') # sent by Telegram in every request, empty doesn't check it
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)) # connections Telegram opens at once
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000)) # updates waiting per worker
+HASH_RING_REPLICAS = 100 # points of every worker in the ring, so the chats are spread evenly
+WORKER_CHECK_INTERVAL = 5 # seconds between the checks of the workers alive
+
+logger = logging.getLogger(__name__)
+
+"""
+Returns the position of the key in the hash ring.
+"""
+def get_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+"""
+Consistent hashing of the keys to the nodes given. Every node has many points in the ring and a key
+belongs to the first point after its own hash, so adding or removing a node only moves the keys of that
+node.
+"""
+class HashRing:
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self.points = sorted((get_hash(str(node) + "-" + str(replica)), node)
+                             for node in nodes for replica in range(replicas))
+        self.positions = [position for position, _ in self.points]
+
+    """
+    Returns the node of the key.
+    """
+    def get_node(self, key):
+        index = bisect.bisect(self.positions, get_hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+"""
+Returns the id of the chat of the update (a dictionary of the Telegram JSON), or of its sender if it
+isn't in a chat (inline queries). Updates without any of them use the update_id.
+"""
+def get_chat_id(update):
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or value.get("message", {}).get("chat")
+        if chat is not None:
+            return chat.get("id")
+        if "from" in value:
+            return value["from"].get("id")
+    return update.get("update_id", 0)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.split("?")[0] != self.server.path:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        try:
+            update = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+        worker = self.server.ring.get_node(get_chat_id(update))
+        try:
+            self.server.queues[worker].put_nowait(update)
+        except queue.Full:
+            # Telegram sends the update again later
+            increment("coco_webhook_updates_total", worker=worker, result="rejected")
+            self.send_response(503)
+            self.send_header("Retry-After", "5")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        increment("coco_webhook_updates_total", worker=worker, result="queued")
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass # quiet
+
+"""
+Runs in every worker process: receives the updates of its queue and passes them to the Application of
+the bot until it receives None.
+"""
+def run_worker(index, workers, updates):
+    # The front end stops the workers, after they finish the updates already queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(serve_updates(index, workers, updates))
+
+async def serve_updates(index, workers, updates):
+    import newbot # imported by the worker, so its caches and stores open their own SQLite connections
+    from quota import places_scheduler, search_scheduler
+    from telegram import Update
+    for scheduler in (places_scheduler, search_scheduler):
+        scheduler.share(workers) # the rate limit is for all the workers together
+
+    application = newbot.build_application()
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        newbot.start_background_jobs(application, refresh_sites=index == 0,
+                                     metrics_port=METRICS_PORT + 1 + index if METRICS_PORT != 0 else 0)
+        newbot.logger.info("Worker %d started", index)
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            except Exception as e:
+                newbot.logger.error("Error %s reading the update %s", str(e), data.get("update_id"))
+        await application.stop()
+    await newbot.close_client()
+
+"""
+Registers WEBHOOK_URL in Telegram, so the updates are sent to it instead of waiting for getUpdates.
+"""
+async def set_webhook():
+    from telegram import Bot, Update
+    async with Bot(str(os.getenv('BOT_TOKEN'))) as bot:
+        await bot.set_webhook(WEBHOOK_URL, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET or None,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS)
+
+"""
+Starts the process of the worker given, reading the queue given.
+"""
+def start_worker(context, index, updates):
+    worker = context.Process(target=run_worker, args=(index, WORKER_PROCESSES, updates),
+                             name="coco-worker-" + str(index))
+    worker.start()
+    return worker
+
+"""
+Returns the gauges of the queues of the workers for the metrics endpoint.
+"""
+def get_queue_metrics(queues):
+    metrics = []
+    for index, updates in enumerate(queues):
+        try:
+            size = updates.qsize()
+        except NotImplementedError:
+            size = None # not available in macOS
+        metrics.append(("coco_webhook_queued", {"worker": index}, size))
+    return metrics
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO,
+        filename="logs.txt",
+        filemode="a"
+    )
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set to the public https url of the webhook")
+    # Every worker starts from a new interpreter, so no SQLite connection is shared between processes
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(WORKER_PROCESSES)]
+    workers = [start_worker(context, index, queues[index]) for index in range(WORKER_PROCESSES)]
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    server.daemon_threads = True
+    server.path = urlparse(WEBHOOK_URL).path or "/"
+    server.ring = HashRing(range(WORKER_PROCESSES))
+    server.queues = queues
+    Thread(target=server.serve_forever, daemon=True).start()
+    register_collector(lambda: get_queue_metrics(queues))
+    start_metrics_server()
+    asyncio.run(set_webhook())
+    logger.info("Webhook listening on %s:%d with %d workers", WEBHOOK_HOST, WEBHOOK_PORT, WORKER_PROCESSES)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # stops as with Ctrl-C
+    try:
+        while True:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.error("Worker %d stopped with code %s, starting it again", index, worker.exitcode)
+                    workers[index] = start_worker(context, index, queues[index])
+    except KeyboardInterrupt:
+        logger.info("Stopping the webhook")
+    finally:
+        server.shutdown()
+        for updates in queues:
+            updates.put(None)
+        for worker in workers:
+            worker.join()
+
+if __name__ == "__main__":
+    main()